@@ -1,5 +1,6 @@
 from flask import (
     Flask,
+    has_app_context,
     request,
     redirect,
     render_template,
@@ -18,13 +19,35 @@ from flask_sock import Sock
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from nh3 import clean, clean_text
-from datetime import datetime
-from markdown import markdown
+from datetime import datetime, timedelta
+from html import unescape
+from math import ceil
+from heapq import heappush, heappushpop
+from threading import (
+    BoundedSemaphore,
+    Event,
+    Lock,
+    Thread,
+    current_thread,
+    local,
+)
+from collections import OrderedDict
+from hashlib import sha256
+from queue import Queue, Empty
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from time import monotonic
+from markdown import Markdown
 from markdown.extensions.fenced_code import FencedCodeExtension as fenced_code
 from markdown.extensions.codehilite import CodeHiliteExtension as codehilite
-from rapidfuzz import fuzz, utils
+from rapidfuzz import fuzz, process, utils
 from pygments import highlight
-from pygments.lexers import guess_lexer_for_filename
+from pygments.lexers import (
+    find_lexer_class,
+    get_all_lexers,
+    guess_lexer_for_filename,
+)
+from pygments.util import ClassNotFound
+from fnmatch import fnmatchcase
 from pygments.formatters import HtmlFormatter
 from sqlalchemy import (
     DateTime,
@@ -33,10 +56,34 @@ from sqlalchemy import (
     String,
     Text,
     Boolean,
+    Index,
+    LargeBinary,
+    event,
     inspect,
+    text,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import (
+    mapped_column,
+    Mapped,
+    relationship,
+    joinedload,
+    contains_eager,
+    aliased,
 )
-from sqlalchemy.orm import mapped_column, Mapped, relationship
 from typing import List
+import numpy
+import gzip
+
+# Optional encodings for compressed responses
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Print decorators
 LOG = '\033[100;92mLOG ::'
@@ -46,10 +93,14 @@ app = Flask(__name__)
 sock = Sock(app)
 app.config['SOCK_SERVER_OPTIONS'] = {'ping_interval': 7}
 import os
+import atexit
+from secrets import token_urlsafe
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
 app.config['SECURITY_PASSWORD_SALT'] = os.environ['SECURITY_PASSWORD_SALT']
-# Bcrypt Setup
+# Bcrypt Setup, hashes of another cost are redone on their next login
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
 bcrypt = Bcrypt(app)
 
 # Login manager setup
@@ -58,7 +109,9 @@ login_manager.init_app(app)
 # }}}
 # Flask-SQLAlchemy Database{{{
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+    'DATABASE_URL', 'sqlite:///app.db'
+)
 app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     'pool_pre_ping': True,
 }
@@ -66,6 +119,44 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy()
 db.init_app(app)
 
+# Pragmas run on every new SQLite connection, picked with SQLITE_PROFILE.
+# 'default' leaves SQLite as it is, 'tuned' lets readers carry on while a
+# worker writes and has writers wait for the lock instead of failing
+sqlite_profiles = {
+    'default': {},
+    'tuned': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'mmap_size': 268435456,
+        'cache_size': -65536,
+        'temp_store': 'MEMORY',
+    },
+}
+app.config['SQLITE_PROFILE'] = os.environ.get('SQLITE_PROFILE', 'tuned')
+if app.config['SQLITE_PROFILE'] not in sqlite_profiles:
+    raise ValueError(
+        f'SQLITE_PROFILE must be one of {", ".join(sqlite_profiles)}, '
+        f'not {app.config["SQLITE_PROFILE"]!r}'
+    )
+
+
+def sqlite_pragmas(profile):
+    def apply_pragmas(connection, record):
+        cursor = connection.cursor()
+        for pragma, value in sqlite_profiles[profile].items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+        cursor.close()
+
+    return apply_pragmas
+
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(
+            db.engine, 'connect', sqlite_pragmas(app.config['SQLITE_PROFILE'])
+        )
+
 
 class User(UserMixin, db.Model):
     __tablename__ = 'user_table'
@@ -89,25 +180,41 @@ class Yell(db.Model):
     yell_title: Mapped[str] = mapped_column(String(100), nullable=False)
     yell_type: Mapped[str] = mapped_column(String(3), nullable=False)
     yell_datetime: Mapped[datetime] = mapped_column(
-        DateTime, default=datetime.utcnow()
+        DateTime, default=datetime.utcnow
     )
 
-    yell_rating: Mapped[int] = mapped_column(Integer, default=0)
+    yell_rating: Mapped[int] = mapped_column(Integer, default=0, index=True)
     yell_comments: Mapped[int] = mapped_column(Integer, default=0)
 
+    __table_args__ = (
+        # Keyset pagination of the feeds
+        Index('ix_yell_type_id', 'yell_type', 'yell_id'),
+    )
+
     def __repr__(self):
         return f'<Yell id: {self.yell_id} author: {self.author} title: {self.yell_title}>'
 
 
 class Post(db.Model):
     base_yell_id = mapped_column(
-        ForeignKey('yell_table.yell_id'), nullable=False
+        ForeignKey('yell_table.yell_id'), nullable=False, index=True
     )
     base_yell: Mapped['Yell'] = relationship()
     post_content_id: Mapped[int] = mapped_column(primary_key=True)
     post_description: Mapped[str] = mapped_column(String(5000), nullable=False)
+    # Highlighted HTML of posts from before post_source, new posts leave it
+    # empty and are highlighted on read
     post_code: Mapped[Text] = mapped_column(Text, nullable=False)
     post_filename: Mapped[str] = mapped_column(String(50), nullable=False)
+    post_source: Mapped[Text] = mapped_column(Text, nullable=True)
+    post_lexer: Mapped[str] = mapped_column(String(100), nullable=True)
+    post_lines: Mapped[int] = mapped_column(Integer, nullable=True)
+    post_bytes: Mapped[int] = mapped_column(Integer, nullable=True)
+    # 'rendering' until the render pool has rendered the description and
+    # resolved the lexer, the description is still raw markdown until then
+    post_state: Mapped[str] = mapped_column(
+        String(9), nullable=False, default='ready', server_default='ready'
+    )
 
     def __repr__(self):
         return (
@@ -117,7 +224,7 @@ class Post(db.Model):
 
 class Request(db.Model):
     base_yell_id: Mapped[int] = mapped_column(
-        ForeignKey('yell_table.yell_id'), nullable=False
+        ForeignKey('yell_table.yell_id'), nullable=False, index=True
     )
     base_yell: Mapped['Yell'] = relationship()
     request_content_id: Mapped[int] = mapped_column(primary_key=True)
@@ -131,7 +238,7 @@ class Request(db.Model):
 class CommentSet(db.Model):
     __tablename__ = 'comment_set_table'
     original_yell_id: Mapped[int] = mapped_column(
-        ForeignKey('yell_table.yell_id')
+        ForeignKey('yell_table.yell_id'), index=True
     )
     comment_set_id: Mapped[int] = mapped_column(primary_key=True)
     comment: Mapped[List['Comment']] = relationship()
@@ -141,13 +248,21 @@ class Comment(db.Model):
     __tablename__ = 'comment_table'
     comment_id: Mapped[int] = mapped_column(primary_key=True)
     comment_set_id: Mapped[int] = mapped_column(
-        ForeignKey('comment_set_table.comment_set_id'), nullable=False
+        ForeignKey('comment_set_table.comment_set_id'),
+        nullable=False,
+        index=True,
     )
     base_yell_id: Mapped[int] = mapped_column(
-        ForeignKey('yell_table.yell_id'), nullable=False
+        ForeignKey('yell_table.yell_id'), nullable=False, index=True
     )
     base_yell: Mapped['Yell'] = relationship()
     comment_content: Mapped[str] = mapped_column(String(5000), nullable=False)
+    # The zero padded yell ids from the post or request down to this
+    # comment, so a whole subtree is one range of the index
+    comment_path: Mapped[str] = mapped_column(
+        String, nullable=True, index=True
+    )
+    comment_depth: Mapped[int] = mapped_column(Integer, nullable=True)
 
     # thanks rubber duck
     def to_dict(self):
@@ -160,7 +275,7 @@ class Comment(db.Model):
 class Tag(db.Model):
     tag_id: Mapped[int] = mapped_column(primary_key=True)
     original_yell_id: Mapped[int] = mapped_column(
-        Integer, ForeignKey('yell_table.yell_id'), nullable=False
+        Integer, ForeignKey('yell_table.yell_id'), nullable=False, index=True
     )
     tag_content: Mapped[str] = mapped_column(db.String(180), nullable=False)
 
@@ -179,9 +294,32 @@ class Rating(db.Model):
     )
     # author: Mapped['User'] = relationship()
 
+    __table_args__ = (
+        Index(
+            'uq_rating_yell_critic',
+            'original_yell_id',
+            'critic_id',
+            unique=True,
+        ),
+    )
+
     def __repr__(self):
         return f'<Rating id: {self.rating_id} critic: {self.critic_id} rate: {self.rating}>'
 
+class RatingDelta(db.Model):
+    __tablename__ = 'rating_delta_table'
+    # A +1 or -1 to yell_rating, appended with the rating it comes from and
+    # deleted by fold_ratings in the transaction that applies it
+    delta_id: Mapped[int] = mapped_column(primary_key=True)
+    original_yell_id: Mapped[int] = mapped_column(
+        ForeignKey('yell_table.yell_id'), nullable=False
+    )
+    rating_delta: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<RatingDelta id: {self.delta_id} yell: {self.original_yell_id} delta: {self.rating_delta}>'
+
+
 class Report(db.Model):
     report_id: Mapped[int] = mapped_column(primary_key=True)
     original_yell_id: Mapped[int] = mapped_column(
@@ -193,14 +331,187 @@ class Report(db.Model):
     )
 
 
+class Leaderboard(db.Model):
+    __tablename__ = 'leaderboard_table'
+    # A yell_type or 'all', and 'day', 'week' or 'all'
+    leaderboard_type: Mapped[str] = mapped_column(String(3), primary_key=True)
+    leaderboard_window: Mapped[str] = mapped_column(
+        String(4), primary_key=True
+    )
+    yell_id: Mapped[int] = mapped_column(
+        ForeignKey('yell_table.yell_id'), primary_key=True
+    )
+    yell_rating: Mapped[int] = mapped_column(Integer, nullable=False)
+    yell_datetime: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<Leaderboard {self.leaderboard_type} {self.leaderboard_window} yell: {self.yell_id} rating: {self.yell_rating}>'
+
+
+class LeaderboardBuild(db.Model):
+    __tablename__ = 'leaderboard_build_table'
+    # When each board was last rebuilt, so one that is empty because
+    # nothing is in its window is not rebuilt on every read
+    leaderboard_type: Mapped[str] = mapped_column(String(3), primary_key=True)
+    leaderboard_window: Mapped[str] = mapped_column(
+        String(4), primary_key=True
+    )
+    build_datetime: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<LeaderboardBuild {self.leaderboard_type} {self.leaderboard_window} at: {self.build_datetime}>'
+
+
+class SearchToken(db.Model):
+    __tablename__ = 'search_token_table'
+    search_token: Mapped[str] = mapped_column(String(3), primary_key=True)
+    yell_id: Mapped[int] = mapped_column(
+        ForeignKey('yell_table.yell_id'), primary_key=True
+    )
+
+    def __repr__(self):
+        return f'<SearchToken {self.search_token} yell: {self.yell_id}>'
+
+
+class SearchCache(db.Model):
+    __tablename__ = 'search_cache_table'
+    search_key: Mapped[str] = mapped_column(String, primary_key=True)
+    # Comma separated yell ids, best first
+    search_results: Mapped[str] = mapped_column(Text, nullable=False)
+    search_datetime: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    search_used: Mapped[datetime] = mapped_column(
+        DateTime, nullable=False, index=True
+    )
+
+    def __repr__(self):
+        return f'<SearchCache {self.search_key} used: {self.search_used}>'
+
+
+class SearchGeneration(db.Model):
+    __tablename__ = 'search_generation_table'
+    # One row, counting index writes, so that a ranking scored before one is
+    # not cached after it has emptied search_cache_table
+    generation_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    search_generation: Mapped[int] = mapped_column(Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<SearchGeneration {self.search_generation}>'
+
+
+class SearchSession(db.Model):
+    __tablename__ = 'search_session_table'
+    session_token: Mapped[str] = mapped_column(String(43), primary_key=True)
+    # The whole ranking a search socket pages through, stored in the same
+    # format as SearchCache.search_results
+    session_results: Mapped[str] = mapped_column(Text, nullable=False)
+    session_used: Mapped[datetime] = mapped_column(
+        DateTime, nullable=False, index=True
+    )
+
+    def __repr__(self):
+        return f'<SearchSession {self.session_token} used: {self.session_used}>'
+
+
+class CodeBlob(db.Model):
+    __tablename__ = 'code_blob_table'
+    # The /api/post/<id>/code response of a post, compressed once per style
+    # and encoding
+    post_content_id: Mapped[int] = mapped_column(
+        ForeignKey('post.post_content_id'), primary_key=True
+    )
+    blob_style: Mapped[str] = mapped_column(String(50), primary_key=True)
+    blob_encoding: Mapped[str] = mapped_column(String(4), primary_key=True)
+    blob_data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return f'<CodeBlob post: {self.post_content_id} {self.blob_style} {self.blob_encoding}>'
+
+
 with app.app_context():
     db.create_all()
+    # create_all skips tables that already exist, so add their new columns
+    ddl = db.engine.dialect.ddl_compiler(db.engine.dialect, None)
+    for table in db.metadata.sorted_tables:
+        columns = inspect(db.engine).get_columns(table.name)
+        for column in table.columns:
+            if column.name not in {c['name'] for c in columns}:
+                db.session.execute(
+                    text(
+                        f'ALTER TABLE {table.name} ADD COLUMN '
+                        f'{ddl.get_column_specification(column)}'
+                    )
+                )
+    db.session.commit()
+    # and their new indexes
+    rating_indexes = inspect(db.engine).get_indexes(Rating.__tablename__)
+    if 'uq_rating_yell_critic' not in {i['name'] for i in rating_indexes}:
+        # Keep the newest rating of each critic before enforcing uniqueness
+        db.session.execute(
+            db.delete(Rating).where(
+                Rating.rating_id.not_in(
+                    db.select(db.func.max(Rating.rating_id)).group_by(
+                        Rating.original_yell_id, Rating.critic_id
+                    )
+                )
+            )
+        )
+        db.session.commit()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    # Comments from before comment_path get theirs, parents come first
+    if db.session.execute(
+        db.select(Comment.comment_id).filter_by(comment_path=None).limit(1)
+    ).scalar():
+        paths = {}
+        comments = db.session.execute(
+            db.select(
+                Comment.comment_id,
+                Comment.base_yell_id,
+                CommentSet.original_yell_id,
+            )
+            .join(
+                CommentSet,
+                CommentSet.comment_set_id == Comment.comment_set_id,
+            )
+            .order_by(Comment.comment_id)
+        ).all()
+        for comment_id, base_yell_id, original_yell_id in comments:
+            path, depth = paths.get(
+                original_yell_id, (f'{original_yell_id:010d}/', 0)
+            )
+            paths[base_yell_id] = (path + f'{base_yell_id:010d}/', depth + 1)
+        db.session.execute(
+            db.update(Comment),
+            [
+                dict(
+                    comment_id=comment_id,
+                    comment_path=paths[base_yell_id][0],
+                    comment_depth=paths[base_yell_id][1],
+                )
+                for comment_id, base_yell_id, _ in comments
+            ],
+        )
+        db.session.commit()
+    # Full-text mirror of the searchable text of posts and requests, kept in
+    # sync by index_yell, its rowid is the yell_id
+    db.session.execute(
+        text(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS yell_fts USING fts5('
+            'yell_title, post_description, post_filename, post_code, '
+            'request_content)'
+        )
+    )
+    db.session.commit()
 # }}}
 # Other{{{
 @login_manager.user_loader
 def load_user(id):
     # return User.query.get(id)
-    return db.session.get(User, id)
+    try:
+        return cached_user(int(id))
+    except ValueError:
+        return None
 
 
 @app.errorhandler(404)
@@ -208,6 +519,1385 @@ def page_not_found(error):
     return redirect('/')
 
 
+# }}}
+# Rendering{{{
+class LRUCache:
+    # A bounded mapping that forgets the least recently used entries first
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def contains(self, key):
+        # Unlike get, leaves the hit and miss counters alone
+        with self.lock:
+            return key in self.entries
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            size=len(self.entries),
+            maxsize=self.maxsize,
+        )
+
+
+class TTLCache(LRUCache):
+    # An LRUCache whose entries also expire ttl seconds after they are set
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def contains(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[1] >= monotonic()
+
+    def set(self, key, value):
+        super().set(key, (value, monotonic() + self.ttl))
+
+
+# Sanitized and rendered markdown by the sha256 of its source, so repeated
+# bodies skip the nh3, markdown and codehilite pipeline
+app.config['MARKDOWN_CACHE_SIZE'] = 1024
+markdown_cache = LRUCache(app.config['MARKDOWN_CACHE_SIZE'])
+# Markdown instances are not thread safe, so each thread keeps its own
+markdown_local = local()
+
+
+def render_markdown(text):
+    key = sha256(text.encode()).hexdigest()
+    html = markdown_cache.get(key)
+    if html is None:
+        if not hasattr(markdown_local, 'renderer'):
+            markdown_local.renderer = Markdown(
+                extensions=[
+                    codehilite(
+                        css_class='highlight', pygments_style='one-dark'
+                    ),
+                    fenced_code(),
+                ]
+            )
+        html = markdown_local.renderer.reset().convert(clean(text))
+        markdown_cache.set(key, html)
+    return html
+
+
+# Filename patterns of every lexer, split into exact names, '*.ext' suffixes
+# and the few real globs, so resolving a filename is a couple of dict lookups
+# instead of pygments matching every pattern and analysing the whole code
+app.config['LEXER_SNIFF_SIZE'] = 4096
+lexer_lock = Lock()
+lexer_names = {}
+lexer_suffixes = {}
+lexer_globs = []
+lexer_instances = {}
+
+
+def lexer_matches(filename):
+    with lexer_lock:
+        if not lexer_names:
+            for name, *_ in get_all_lexers():
+                lexer = find_lexer_class(name)
+                for patterns, primary in (
+                    (lexer.filenames, True),
+                    (lexer.alias_filenames, False),
+                ):
+                    for pattern in patterns:
+                        entry = (lexer, primary)
+                        if not any(char in pattern for char in '*?['):
+                            lexer_names.setdefault(pattern, []).append(entry)
+                        elif pattern.startswith('*.') and not any(
+                            char in pattern[2:] for char in '*?['
+                        ):
+                            lexer_suffixes.setdefault(pattern[1:], []).append(
+                                entry
+                            )
+                        else:
+                            lexer_globs.append((pattern, entry))
+    filename = os.path.basename(filename)
+    matches = set(lexer_names.get(filename, []))
+    for position, char in enumerate(filename):
+        if char == '.':
+            matches.update(lexer_suffixes.get(filename[position:], []))
+    matches.update(
+        entry
+        for pattern, entry in lexer_globs
+        if fnmatchcase(filename, pattern)
+    )
+    return matches
+
+
+def resolve_lexer(filename, code):
+    matches = lexer_matches(filename)
+    if not matches:
+        raise ClassNotFound(f'no lexer for filename {filename!r} found')
+    lexers = {lexer for lexer, _ in matches}
+    if len(lexers) == 1 and all(primary for _, primary in matches):
+        lexer = lexers.pop()
+        if lexer not in lexer_instances:
+            lexer_instances[lexer] = lexer()
+        return lexer_instances[lexer]
+    # Ambiguous extensions still need pygments' content analysis, but a
+    # prefix of the code is enough to tell the candidates apart
+    lexer = guess_lexer_for_filename(
+        filename, code[: app.config['LEXER_SNIFF_SIZE']]
+    )
+    return lexer_instances.setdefault(type(lexer), lexer)
+
+
+def lexer_by_name(name):
+    lexer = name and find_lexer_class(name)
+    if not lexer:
+        return None
+    if lexer not in lexer_instances:
+        lexer_instances[lexer] = lexer()
+    return lexer_instances[lexer]
+
+
+# Highlighted HTML by the hash of the source, its lexer and the style, so a
+# new style takes effect without touching the stored posts
+app.config['PYGMENTS_STYLE'] = os.environ.get('PYGMENTS_STYLE', 'one-dark')
+app.config['HIGHLIGHT_CACHE_SIZE'] = 256
+highlight_cache = LRUCache(app.config['HIGHLIGHT_CACHE_SIZE'])
+
+
+def highlight_source(source, lexer_name):
+    key = (
+        sha256(source.encode()).hexdigest(),
+        lexer_name,
+        app.config['PYGMENTS_STYLE'],
+    )
+    html = highlight_cache.get(key)
+    if html is None:
+        lexer = lexer_by_name(lexer_name)
+        if lexer:
+            html = highlight(
+                source,
+                lexer,
+                HtmlFormatter(
+                    cssclass='highlight',
+                    style=app.config['PYGMENTS_STYLE'],
+                    linenos='table',
+                    wrapcode=True,
+                ),
+            )
+        else:
+            # Filenames without a lexer are shown as escaped text
+            html = clean_text(source)
+        highlight_cache.set(key, html)
+    return html
+
+
+def highlight_post(post):
+    if post.post_source is None:
+        return post.post_code
+    return highlight_source(post.post_source, post.post_lexer)
+
+
+# Feed cards only carry the first PREVIEW_LINES lines of a post, the rest is
+# fetched from /api/post/<id>/code when the card is expanded
+app.config['PREVIEW_LINES'] = 15
+
+
+def post_excerpt(source):
+    end = -1
+    for _ in range(app.config['PREVIEW_LINES']):
+        end = source.find('\n', end + 1)
+        if end == -1:
+            return source
+    return source[:end]
+
+
+def preview_post(post):
+    # The highlighted excerpt and whether it cut anything off
+    if post.post_source is None:
+        return post.post_code, False
+    excerpt = post_excerpt(post.post_source)
+    return (
+        highlight_source(excerpt, post.post_lexer),
+        len(excerpt.rstrip('\n')) < len(post.post_source.rstrip('\n')),
+    )
+
+
+def source_sizes(source):
+    return len(source.splitlines()), len(source.encode())
+
+
+@app.cli.command('backfill-sources')
+def backfill_sources():
+    """Store the raw source of posts saved as highlighted HTML only."""
+    posts = (
+        db.session.execute(db.select(Post).filter_by(post_source=None))
+        .scalars()
+        .all()
+    )
+    for post in posts:
+        post.post_source = post_source(post).rstrip('\n')
+        try:
+            post.post_lexer = resolve_lexer(
+                strip_html(post.post_filename), post.post_source
+            ).name
+        except ClassNotFound:
+            post.post_lexer = None
+        post.post_lines, post.post_bytes = source_sizes(post.post_source)
+        post.post_code = ''
+    db.session.execute(
+        db.delete(CodeBlob).where(
+            CodeBlob.post_content_id.in_(
+                [post.post_content_id for post in posts]
+            )
+        )
+    )
+    db.session.commit()
+    # Give the space of the dropped HTML back to the filesystem
+    db.session.execute(text('VACUUM'))
+    print(LOG, f'{len(posts)} posts backfilled', END)
+
+
+# }}}
+# User cache{{{
+# Every request with a session loads its user and every single card its
+# author, so both read id and username from a per process cache instead of
+# user_table. Writes to a user call forget_user, other processes catch up
+# within USER_CACHE_TTL seconds
+app.config['USER_CACHE_SIZE'] = 4096
+app.config['USER_CACHE_TTL'] = 300
+user_cache = TTLCache(
+    app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL']
+)
+
+
+class CachedUser(UserMixin):
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+    def __repr__(self):
+        return f'<CachedUser {self.id} {self.username}>'
+
+
+def cached_user(user_id):
+    user = user_cache.get(user_id)
+    if user is None:
+        row = db.session.execute(
+            db.select(User.id, User.username).filter_by(id=user_id)
+        ).first()
+        if row is None:
+            return None
+        user = CachedUser(*row)
+        user_cache.set(user_id, user)
+    return user
+
+
+def cache_users(user_ids):
+    # Loads every user of a page that is not cached yet in one query
+    missing = {i for i in user_ids if not user_cache.contains(i)}
+    if missing:
+        for row in db.session.execute(
+            db.select(User.id, User.username).where(User.id.in_(missing))
+        ):
+            user_cache.set(row.id, CachedUser(*row))
+
+
+def forget_user(user_id):
+    user_cache.delete(user_id)
+
+
+def yell_author(yell):
+    return cached_user(yell.author_id).username
+
+
+# }}}
+# Passwords{{{
+# bcrypt is slow on purpose, so hashing and checking run on a few threads
+# per process instead of the request threads, bcrypt releases the GIL
+# meanwhile. Past PASSWORD_WORKERS + PASSWORD_QUEUE passwords in flight,
+# register and login fail fast instead of piling up behind a login storm
+app.config['PASSWORD_WORKERS'] = 2
+app.config['PASSWORD_QUEUE'] = 8
+app.config['PASSWORD_TIMEOUT'] = 10
+password_pool = ThreadPoolExecutor(
+    max_workers=app.config['PASSWORD_WORKERS'], thread_name_prefix='password'
+)
+password_slots = BoundedSemaphore(
+    app.config['PASSWORD_WORKERS'] + app.config['PASSWORD_QUEUE']
+)
+
+
+class PasswordBusy(Exception):
+    pass
+
+
+def password_work(work, *args):
+    if not password_slots.acquire(blocking=False):
+        raise PasswordBusy
+    try:
+        future = password_pool.submit(work, *args)
+    except Exception:
+        password_slots.release()
+        raise
+    future.add_done_callback(lambda future: password_slots.release())
+    return future
+
+
+def password_result(work, *args):
+    try:
+        return password_work(work, *args).result(
+            timeout=app.config['PASSWORD_TIMEOUT']
+        )
+    except TimeoutError:
+        raise PasswordBusy
+
+
+def hash_rounds(hash):
+    # $2b$<rounds>$<salt and hash>
+    if isinstance(hash, bytes):
+        hash = hash.decode()
+    return int(hash.split('$')[2])
+
+
+def write_hash(user_id, hash):
+    db.session.execute(db.update(User).filter_by(id=user_id).values(hash=hash))
+    forget_user(user_id)
+
+
+def rehash_password(user_id, password):
+    # Not waited on, so the password worker is free once the hash is done
+    write_queue.defer(
+        write_hash, user_id, bcrypt.generate_password_hash(password)
+    )
+
+
+# }}}
+# Search index{{{
+# Trigrams of every searchable field point back to their yell, so a search
+# only has to fuzzy score the yells sharing enough trigrams with the query.
+app.config['SEARCH_MIN_OVERLAP'] = 0.3
+app.config['SEARCH_MAX_CANDIDATES'] = 1000
+# Postings read per query trigram, see search_candidates
+app.config['SEARCH_MAX_POSTINGS'] = 2000
+app.config['SEARCH_BATCH_SIZE'] = 500
+# Scored yells kept per process, see SearchCorpus
+app.config['SEARCH_CORPUS_SIZE'] = 10000
+# Characters of a post's source that are scored, its lightest field
+app.config['SEARCH_CODE_PREFIX'] = 2048
+app.config['SEARCH_CHUNK_SIZE'] = 4096
+app.config['SEARCH_THRESHOLD'] = 80
+# rapidfuzz worker threads per search, -1 uses every core
+app.config['SEARCH_WORKERS'] = -1
+# Only the best SEARCH_TOP_K results are ranked and paged through
+app.config['SEARCH_TOP_K'] = 300
+app.config['SEARCH_PAGE_SIZE'] = 15
+# 'fuzzy' scores trigram candidates with rapidfuzz, 'fts' ranks yell_fts
+# matches by BM25 and re-ranks the best SEARCH_FTS_RERANK with rapidfuzz
+search_modes = ('fuzzy', 'fts')
+app.config['SEARCH_MODE'] = os.environ.get('SEARCH_MODE', 'fuzzy')
+app.config['SEARCH_FTS_RERANK'] = 50
+# BM25 weight of each yell_fts column, in column order
+app.config['SEARCH_FTS_WEIGHTS'] = (10.0, 1.0, 5.0, 1.0, 1.0)
+# Ranked results are cached per normalized query in search_cache_table,
+# shared by every worker and emptied whenever a yell is indexed
+app.config['SEARCH_CACHE_SIZE'] = 1000
+app.config['SEARCH_CACHE_TTL'] = 3600
+# A hit only moves its entry up the eviction order again after this long
+app.config['SEARCH_CACHE_TOUCH'] = 300
+# Search sessions keep a ranked result list for paging and are dropped after
+# being idle for this many seconds
+app.config['SEARCH_SESSION_IDLE'] = 900
+
+
+def strip_html(text):
+    return unescape(clean(text or '', tags=set()))
+
+
+def post_source(post):
+    if post.post_source is not None:
+        return post.post_source
+    # Drop the line number column of the highlighted table
+    code = post.post_code
+    if '<td class="code">' in code:
+        code = code.split('<td class="code">', 1)[1]
+    return strip_html(code)
+
+
+def search_trigrams(text):
+    trigrams = set()
+    for word in utils.default_process(str(text)).split():
+        padded = f'  {word} '
+        trigrams.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return trigrams
+
+
+def search_fields(yell, content):
+    match (yell.yell_type):
+        case 'pst':
+            fields = [
+                yell.yell_title,
+                content.post_description,
+                content.post_filename,
+                yell.author.username,
+            ]
+        case 'req':
+            fields = [
+                yell.yell_title,
+                content.request_content,
+                yell.author.username,
+            ]
+        case _:
+            fields = []
+    return [strip_html(field) for field in fields]
+
+
+def index_yell(yell, content):
+    db.session.execute(db.delete(SearchCache))
+    db.session.execute(
+        sqlite_insert(SearchGeneration)
+        .values(generation_id=1, search_generation=1)
+        .on_conflict_do_update(
+            index_elements=['generation_id'],
+            set_={'search_generation': SearchGeneration.search_generation + 1},
+        )
+    )
+    db.session.execute(db.delete(SearchToken).filter_by(yell_id=yell.yell_id))
+    trigrams = set()
+    for field in search_fields(yell, content):
+        trigrams |= search_trigrams(field)
+    if trigrams:
+        db.session.execute(
+            db.insert(SearchToken),
+            [
+                {'search_token': trigram, 'yell_id': yell.yell_id}
+                for trigram in trigrams
+            ],
+        )
+
+    db.session.execute(
+        text('DELETE FROM yell_fts WHERE rowid = :yell_id'),
+        {'yell_id': yell.yell_id},
+    )
+    match (yell.yell_type):
+        case 'pst':
+            row = {
+                'post_description': strip_html(content.post_description),
+                'post_filename': strip_html(content.post_filename),
+                'post_code': post_source(content),
+                'request_content': '',
+            }
+        case 'req':
+            row = {
+                'post_description': '',
+                'post_filename': '',
+                'post_code': '',
+                'request_content': strip_html(content.request_content),
+            }
+        case _:
+            return
+    db.session.execute(
+        text(
+            'INSERT INTO yell_fts (rowid, yell_title, post_description, '
+            'post_filename, post_code, request_content) VALUES (:yell_id, '
+            ':yell_title, :post_description, :post_filename, :post_code, '
+            ':request_content)'
+        ),
+        {
+            'yell_id': yell.yell_id,
+            'yell_title': strip_html(yell.yell_title),
+            **row,
+        },
+    )
+
+
+def trigram_postings(trigram, limit):
+    # At most limit of the yells holding trigram
+    return (
+        db.select(SearchToken.yell_id)
+        .filter_by(search_token=trigram)
+        .limit(limit)
+        .subquery()
+    )
+
+
+def search_candidates(searched):
+    trigrams = sorted(search_trigrams(searched))
+    if not trigrams:
+        return []
+    # How many yells hold each trigram, counted no further than the cap so
+    # that sizing up a common trigram costs no more than a rare one
+    cap = app.config['SEARCH_MAX_POSTINGS']
+    sizes = db.session.execute(
+        db.select(
+            *[
+                db.select(db.func.count())
+                .select_from(trigram_postings(trigram, cap + 1))
+                .scalar_subquery()
+                for trigram in trigrams
+            ]
+        )
+    ).one()
+    held = [(size, trigram) for trigram, size in zip(trigrams, sizes) if size]
+    if not held:
+        return []
+    min_hits = ceil(len(trigrams) * app.config['SEARCH_MIN_OVERLAP'])
+    hits = db.func.count()
+    select = (
+        db.select(SearchToken.yell_id)
+        .where(SearchToken.search_token.in_([trigram for _, trigram in held]))
+        .group_by(SearchToken.yell_id)
+        .having(hits >= min_hits)
+        .order_by(hits.desc())
+        .limit(app.config['SEARCH_MAX_CANDIDATES'])
+    )
+    # Yells are drawn from the whole posting lists of the trigrams in at
+    # most cap yells, and the common trigrams are only looked up for the
+    # cap drawn yells holding the most rare ones. With no rare trigram to
+    # draw from, every posting list is read whole.
+    rare = [trigram for size, trigram in held if size <= cap]
+    if rare:
+        # A yell short of min_hits even with every common one cannot match
+        drawn = db.func.count()
+        pool = (
+            db.select(SearchToken.yell_id)
+            .where(SearchToken.search_token.in_(rare))
+            .group_by(SearchToken.yell_id)
+            .having(drawn >= min_hits - (len(held) - len(rare)))
+            .order_by(drawn.desc())
+            .limit(cap)
+        )
+        select = select.where(SearchToken.yell_id.in_(pool))
+    return db.session.execute(select).scalars().all()
+
+
+def search_rows(candidates=None):
+    # One statement per batch loads each yell with its post or request and
+    # author, instead of a select per yell and a lazy load per author
+    select = (
+        db.select(Yell, Post, Request)
+        .outerjoin(Post, Post.base_yell_id == Yell.yell_id)
+        .outerjoin(Request, Request.base_yell_id == Yell.yell_id)
+        .options(joinedload(Yell.author))
+        .where(Yell.yell_type.in_(('pst', 'req')))
+        .execution_options(yield_per=app.config['SEARCH_BATCH_SIZE'])
+    )
+    if candidates is not None:
+        select = select.where(Yell.yell_id.in_(candidates))
+    for yell, post, req in db.session.execute(select):
+        content = post or req
+        if content:
+            yield yell, content
+
+
+def score_fields(yell, content):
+    # A field is weighted by its position, so the first one never counts
+    match (yell.yell_type):
+        case 'pst':
+            return [
+                content.post_description,
+                post_source(content)[: app.config['SEARCH_CODE_PREFIX']],
+                content.post_filename,
+                yell.author.username,
+                yell.yell_datetime,
+                yell.yell_rating,
+                yell.yell_title,
+            ]
+        case 'req':
+            return [
+                content.request_content,
+                yell.author.username,
+                yell.yell_datetime,
+                yell.yell_rating,
+                yell.yell_title,
+            ]
+
+
+class SearchCorpus(LRUCache):
+    # The searchable fields of the yells searches scored lately, already run
+    # through utils.default_process, by yell id. Rows are loaded the first
+    # time one of their yells is a candidate, so a new worker pays for
+    # loading up to SEARCH_MAX_CANDIDATES rows on each of its first searches
+    # instead of for the whole table on its first one
+
+    def rows(self, candidates):
+        rows = {}
+        missing = []
+        for yell_id in candidates:
+            row = self.get(yell_id)
+            if row is None:
+                missing.append(yell_id)
+            else:
+                rows[yell_id] = row
+        if missing:
+            for yell, content in search_rows(missing):
+                row = (
+                    yell.yell_type,
+                    [
+                        utils.default_process(str(field))
+                        for field in score_fields(yell, content)
+                    ],
+                )
+                self.set(yell.yell_id, row)
+                rows[yell.yell_id] = row
+        return rows
+
+    def top(self, searched, candidates, threshold=None):
+        if threshold is None:
+            threshold = app.config['SEARCH_THRESHOLD']
+        query = utils.default_process(str(searched))
+        chunk_size = app.config['SEARCH_CHUNK_SIZE']
+        heap = []
+        typed = {'pst': [], 'req': []}
+        for yell_id, (yell_type, fields) in self.rows(candidates).items():
+            typed[yell_type].append((yell_id, fields))
+        for chunked in typed.values():
+            for start in range(0, len(chunked), chunk_size):
+                chunk = chunked[start : start + chunk_size]
+                self.score_chunk(query, chunk, heap, threshold)
+        return [yell_id for score, yell_id in sorted(heap, reverse=True)]
+
+    def score_chunk(self, query, chunk, heap, threshold):
+        # Fields are scored heaviest first, and after each one the rows that
+        # could not reach the threshold or beat the current k-th best score
+        # even with a perfect score on every remaining field are dropped
+        ids = [yell_id for yell_id, values in chunk]
+        fields = list(zip(*[values for yell_id, values in chunk]))
+        top_k = app.config['SEARCH_TOP_K']
+        weights = list(range(len(fields) - 1, 0, -1))
+        remaining = sum(weights)
+        floor = threshold * len(fields)
+        if len(heap) >= top_k and heap[0][0] >= remaining * 100 / len(fields):
+            return
+        rows = numpy.arange(len(chunk))
+        total = numpy.zeros(len(chunk))
+        for weight in weights:
+            values = fields[weight]
+            total += weight * process.cdist(
+                [query],
+                [values[position] for position in rows.tolist()],
+                scorer=fuzz.WRatio,
+                dtype=numpy.float64,
+                workers=app.config['SEARCH_WORKERS'],
+            )[0]
+            remaining -= weight
+            best = total + remaining * 100
+            keep = best >= floor
+            if len(heap) >= top_k:
+                keep &= best > heap[0][0] * len(fields)
+            rows, total = rows[keep], total[keep]
+            if not len(rows):
+                return
+        scores = (total / len(fields)).tolist()
+        for position, score in zip(rows.tolist(), scores):
+            if len(heap) < top_k:
+                heappush(heap, (score, ids[position]))
+            elif score > heap[0][0]:
+                heappushpop(heap, (score, ids[position]))
+
+
+search_corpus = SearchCorpus(app.config['SEARCH_CORPUS_SIZE'])
+
+
+def fts_search(searched):
+    words = utils.default_process(str(searched)).split()
+    if not words:
+        return []
+    weights = ', '.join(map(str, app.config['SEARCH_FTS_WEIGHTS']))
+    ranked = (
+        db.session.execute(
+            text(
+                'SELECT rowid FROM yell_fts WHERE yell_fts MATCH :match '
+                f'ORDER BY bm25(yell_fts, {weights}) LIMIT :limit'
+            ),
+            {
+                'match': ' OR '.join(f'"{word}"*' for word in words),
+                'limit': app.config['SEARCH_TOP_K'],
+            },
+        )
+        .scalars()
+        .all()
+    )
+    # Only the head is fuzzy scored, weighted like SearchCorpus.top
+    head = ranked[: app.config['SEARCH_FTS_RERANK']]
+    query = utils.default_process(str(searched))
+    scores = []
+    for yell_id, (yell_type, fields) in search_corpus.rows(head).items():
+        score = sum(
+            weight * fuzz.WRatio(query, fields[weight])
+            for weight in range(1, len(fields))
+        )
+        scores.append((score / len(fields), yell_id))
+    scores.sort(reverse=True)
+    return [yell_id for score, yell_id in scores] + ranked[len(head) :]
+
+
+def search_mode():
+    # ?mode= of the request if it is a known one, so made up modes do not
+    # each get their own cache entries
+    mode = request.args.get('mode')
+    if mode in search_modes:
+        return mode
+    return app.config['SEARCH_MODE']
+
+
+def search_generation():
+    return (
+        db.session.execute(
+            db.select(SearchGeneration.search_generation)
+        ).scalar()
+        or 0
+    )
+
+
+def write_search_cache(key, results, now, generation):
+    # The yells were indexed again since the ranking was scored
+    if search_generation() != generation:
+        return
+    db.session.merge(
+        SearchCache(
+            search_key=key,
+            search_results=results,
+            search_datetime=now,
+            search_used=now,
+        )
+    )
+    db.session.flush()
+    db.session.execute(
+        db.delete(SearchCache).where(
+            SearchCache.search_key.in_(
+                db.select(SearchCache.search_key)
+                .order_by(SearchCache.search_used.desc())
+                .offset(app.config['SEARCH_CACHE_SIZE'])
+            )
+        )
+    )
+
+
+def write_search_used(key, now):
+    db.session.execute(
+        db.update(SearchCache)
+        .filter_by(search_key=key)
+        .values(search_used=now)
+    )
+
+
+def search_ranked(searched, mode):
+    query = ' '.join(utils.default_process(str(searched)).split())
+    key = f'{mode}:{query}'
+    now = datetime.utcnow()
+    cached = db.session.get(SearchCache, key)
+    ttl = timedelta(seconds=app.config['SEARCH_CACHE_TTL'])
+    if cached and now - cached.search_datetime < ttl:
+        touch = timedelta(seconds=app.config['SEARCH_CACHE_TOUCH'])
+        if now - cached.search_used > touch:
+            write_queue.defer(write_search_used, key, now)
+        return [
+            int(yell_id)
+            for yell_id in cached.search_results.split(',')
+            if yell_id
+        ]
+
+    # Read in the same snapshot as the index the ranking is scored from
+    generation = search_generation()
+    if mode == 'fts':
+        ranked = fts_search(searched)
+    else:
+        ranked = search_corpus.top(searched, search_candidates(searched))
+
+    write_queue.defer(
+        write_search_cache,
+        key,
+        ','.join(map(str, ranked)),
+        now,
+        generation,
+    )
+    return ranked
+
+
+@app.cli.command('reindex')
+def reindex():
+    """Rebuild the search index from every post and request."""
+    db.session.execute(db.delete(SearchToken))
+    db.session.execute(text('DELETE FROM yell_fts'))
+    for yell, content in list(search_rows()):
+        index_yell(yell, content)
+    db.session.commit()
+    print(LOG, 'search index rebuilt', END)
+
+
+# }}}
+# Leaderboard{{{
+# The best rated yells of each type and of every type, per time window, kept
+# up to date by do_rate so the homepage never sorts yell_table. Reads
+# rebuild a board that was never built, or one that is empty or has yells
+# aged out of its window once it is LEADERBOARD_REBUILD seconds old
+app.config['LEADERBOARD_SIZE'] = 20
+app.config['LEADERBOARD_REBUILD'] = 300
+leaderboard_windows = {
+    'day': timedelta(days=1),
+    'week': timedelta(weeks=1),
+    'all': None,
+}
+
+
+def leaderboard_cutoff(window):
+    if not leaderboard_windows[window]:
+        return datetime.min
+    return datetime.utcnow() - leaderboard_windows[window]
+
+
+def rebuild_leaderboard(board_type, window):
+    db.session.execute(
+        db.delete(Leaderboard).filter_by(
+            leaderboard_type=board_type, leaderboard_window=window
+        )
+    )
+    select = (
+        db.select(Yell.yell_id, Yell.yell_rating, Yell.yell_datetime)
+        .where(Yell.yell_datetime >= leaderboard_cutoff(window))
+        .order_by(Yell.yell_rating.desc(), Yell.yell_id.desc())
+        .limit(app.config['LEADERBOARD_SIZE'])
+    )
+    if board_type != 'all':
+        select = select.where(Yell.yell_type == board_type)
+    for yell_id, yell_rating, yell_datetime in db.session.execute(select):
+        db.session.add(
+            Leaderboard(
+                leaderboard_type=board_type,
+                leaderboard_window=window,
+                yell_id=yell_id,
+                yell_rating=yell_rating,
+                yell_datetime=yell_datetime,
+            )
+        )
+    db.session.merge(
+        LeaderboardBuild(
+            leaderboard_type=board_type,
+            leaderboard_window=window,
+            build_datetime=datetime.utcnow(),
+        )
+    )
+    db.session.flush()
+
+
+def rank_yell(yell_id):
+    # Called after the rating of yell_id changed, inside the same transaction
+    yell_rating, yell_type, yell_datetime = db.session.execute(
+        db.select(Yell.yell_rating, Yell.yell_type, Yell.yell_datetime).where(
+            Yell.yell_id == yell_id
+        )
+    ).one()
+    for board_type in (yell_type, 'all'):
+        for window in leaderboard_windows:
+            if yell_datetime < leaderboard_cutoff(window):
+                continue
+            board = dict(
+                db.session.execute(
+                    db.select(Leaderboard.yell_id, Leaderboard.yell_rating)
+                    .filter_by(
+                        leaderboard_type=board_type, leaderboard_window=window
+                    )
+                ).all()
+            )
+            if not board:
+                rebuild_leaderboard(board_type, window)
+                continue
+            others = [
+                rating for other, rating in board.items() if other != yell_id
+            ]
+            full = len(board) >= app.config['LEADERBOARD_SIZE']
+            if yell_id in board:
+                if full and others and yell_rating < min(others):
+                    # A yell that is not on the board may be better now
+                    rebuild_leaderboard(board_type, window)
+                    continue
+                db.session.execute(
+                    db.update(Leaderboard)
+                    .filter_by(
+                        leaderboard_type=board_type,
+                        leaderboard_window=window,
+                        yell_id=yell_id,
+                    )
+                    .values(yell_rating=yell_rating)
+                )
+            elif not full or yell_rating > min(others):
+                db.session.add(
+                    Leaderboard(
+                        leaderboard_type=board_type,
+                        leaderboard_window=window,
+                        yell_id=yell_id,
+                        yell_rating=yell_rating,
+                        yell_datetime=yell_datetime,
+                    )
+                )
+                if full:
+                    db.session.execute(
+                        db.delete(Leaderboard).where(
+                            Leaderboard.leaderboard_type == board_type,
+                            Leaderboard.leaderboard_window == window,
+                            Leaderboard.yell_id
+                            == min(board, key=lambda id: (board[id], id)),
+                        )
+                    )
+
+
+def top_rated(board_type, window, limit=None):
+    select = (
+        db.select(Leaderboard.yell_id, Leaderboard.yell_datetime)
+        .filter_by(leaderboard_type=board_type, leaderboard_window=window)
+        .order_by(Leaderboard.yell_rating.desc(), Leaderboard.yell_id.desc())
+    )
+    board = db.session.execute(select).all()
+    built = db.session.execute(
+        db.select(LeaderboardBuild.build_datetime).filter_by(
+            leaderboard_type=board_type, leaderboard_window=window
+        )
+    ).scalar()
+    cutoff = leaderboard_cutoff(window)
+    aged = any(yell_datetime < cutoff for _, yell_datetime in board)
+    rebuilt = timedelta(seconds=app.config['LEADERBOARD_REBUILD'])
+    if built is None or (
+        (aged or not board) and datetime.utcnow() - built > rebuilt
+    ):
+        # Rebuilt by the writer, which also runs rank_yell
+        write_queue.submit(rebuild_leaderboard, board_type, window)
+        board = db.session.execute(select).all()
+    return [
+        yell_id for yell_id, yell_datetime in board if yell_datetime >= cutoff
+    ][:limit]
+
+
+# }}}
+# Write queue{{{
+# SQLite only has one writer at a time, so the request threads of a worker
+# process hand their writes to one writer thread of that process instead of
+# each opening their own transaction. A lone write commits right away, and
+# the writes that queue up while the writer commits share its next
+# transaction, up to WRITE_BATCH_SIZE of them. The worker processes still
+# take turns on the SQLite write lock, waiting on busy_timeout, which is why
+# uwsgi.ini runs a few processes with several request threads each. Reads
+# still go straight to the database. WRITE_QUEUE=off runs each write inline
+# in the request instead. A write still queued after WRITE_TIMEOUT seconds
+# is dropped and WriteBusy answers with a 503
+app.config['WRITE_QUEUE'] = os.environ.get('WRITE_QUEUE', 'on') != 'off'
+app.config['WRITE_BATCH_SIZE'] = 64
+app.config['WRITE_TIMEOUT'] = 30
+
+
+class WorkerThread:
+    # A daemon thread running target, started in each worker process the
+    # first time start is called there, since threads do not survive a
+    # fork. setup runs first, to replace state inherited from the parent
+    def __init__(self, target, setup=None):
+        self.target = target
+        self.setup = setup
+        self.lock = Lock()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            if self.setup:
+                self.setup()
+            self.thread = Thread(target=self.target, daemon=True)
+            self.thread.start()
+
+    def is_current(self):
+        return current_thread() is self.thread
+
+
+class WriteBusy(Exception):
+    pass
+
+
+class WriteQueue:
+    def __init__(self):
+        self.queue = Queue()
+        self.writer = WorkerThread(self.run, self.reset)
+
+    def reset(self):
+        # Writes queued before the fork belong to the parent's writer
+        self.queue = Queue()
+
+    def submit(self, write, *args):
+        # Writes only touch the database and return plain values, since the
+        # writer's session is gone by the time the caller gets the result
+        if self.writer.is_current():
+            return write(*args)
+        if has_app_context():
+            # The writer draws from the same pool, so give back the
+            # connection the request read with before waiting on it
+            db.session.close()
+        if not app.config['WRITE_QUEUE']:
+            with app.app_context():
+                result = write(*args)
+                db.session.commit()
+            return result
+        future = self.put(write, args)
+        try:
+            return future.result(timeout=app.config['WRITE_TIMEOUT'])
+        except TimeoutError:
+            # Only a write the writer has not started can be dropped, one
+            # it has started is part of a batch that is about to commit
+            if future.cancel():
+                raise WriteBusy
+            return future.result()
+
+    def defer(self, write, *args):
+        # Queues a write and returns without waiting for it, for writes
+        # nobody needs the result of. Failures are only logged
+        if not app.config['WRITE_QUEUE'] or self.writer.is_current():
+            self.submit(write, *args)
+            return
+        self.put(write, args).add_done_callback(self.report)
+
+    def report(self, future):
+        if future.cancelled() or not future.exception():
+            return
+        print(LOG, f'deferred write failed: {future.exception()!r}', END)
+
+    def put(self, write, args):
+        self.writer.start()
+        future = Future()
+        self.queue.put((future, write, args))
+        return future
+
+    def run(self):
+        while True:
+            # Waits for one write, then takes whatever else is queued
+            # without waiting for more
+            batch = []
+            item = self.queue.get()
+            while True:
+                # Writes their request gave up on are skipped
+                if item[0].set_running_or_notify_cancel():
+                    batch.append(item)
+                if len(batch) >= app.config['WRITE_BATCH_SIZE']:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except Empty:
+                    break
+            if batch:
+                with app.app_context():
+                    self.commit(batch)
+
+    def commit(self, batch):
+        try:
+            results = [write(*args) for future, write, args in batch]
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+        else:
+            for (future, write, args), result in zip(batch, results):
+                future.set_result(result)
+            return
+
+        # One write failed and took the batch with it, so commit them one by
+        # one and only fail the one that breaks
+        for future, write, args in batch:
+            try:
+                result = write(*args)
+                db.session.commit()
+            except Exception as error:
+                db.session.rollback()
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+write_queue = WriteQueue()
+
+
+@app.errorhandler(WriteBusy)
+def write_busy(error):
+    return 'Too busy to save this right now, try again soon', 503
+
+
+# }}}
+# Compression{{{
+# JSON responses over COMPRESS_MIN_SIZE bytes are compressed with the best
+# encoding the client accepts. The full code of a post is the heaviest of
+# them, so it is compressed once at the highest levels when the post is
+# rendered and get_post_code sends the stored bytes as they are
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_GZIP_LEVEL'] = 6
+app.config['COMPRESS_BROTLI_QUALITY'] = 5
+app.config['COMPRESS_ZSTD_LEVEL'] = 3
+content_encodings = [
+    encoding
+    for encoding, module in (
+        ('br', brotli),
+        ('zstd', zstandard),
+        ('gzip', gzip),
+    )
+    if module
+]
+code_blobs_pending = set()
+
+
+def compress(data, encoding, stored=False):
+    match (encoding):
+        case 'br':
+            quality = app.config['COMPRESS_BROTLI_QUALITY']
+            return brotli.compress(data, quality=11 if stored else quality)
+        case 'zstd':
+            level = app.config['COMPRESS_ZSTD_LEVEL']
+            return zstandard.ZstdCompressor(
+                level=19 if stored else level
+            ).compress(data)
+        case 'gzip':
+            level = app.config['COMPRESS_GZIP_LEVEL']
+            return gzip.compress(data, compresslevel=9 if stored else level)
+
+
+@app.after_request
+def compress_response(response):
+    if (
+        response.mimetype != 'application/json'
+        or response.status_code != 200
+    ):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+    encoding = request.accept_encodings.best_match(content_encodings)
+    data = response.get_data()
+    if not encoding or len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def post_code_json(post):
+    return app.json.dumps(
+        dict(
+            post_code=highlight_post(post),
+            post_lines=post.post_lines,
+            post_bytes=post.post_bytes,
+        )
+    ).encode()
+
+
+def write_code_blobs(post_content_id, style, blobs):
+    db.session.execute(
+        sqlite_insert(CodeBlob)
+        .values(
+            [
+                dict(
+                    post_content_id=post_content_id,
+                    blob_style=style,
+                    blob_encoding=encoding,
+                    blob_data=data,
+                )
+                for encoding, data in blobs
+            ]
+        )
+        .on_conflict_do_nothing()
+    )
+
+
+def store_code_blobs(post_content_id):
+    style = app.config['PYGMENTS_STYLE']
+    try:
+        with app.app_context():
+            data = post_code_json(db.session.get(Post, post_content_id))
+        blobs = [
+            (encoding, compress(data, encoding, stored=True))
+            for encoding in content_encodings
+        ]
+        write_queue.submit(write_code_blobs, post_content_id, style, blobs)
+    finally:
+        code_blobs_pending.discard((post_content_id, style))
+
+
+# }}}
+# Render pool{{{
+# post() stores a submission as it was typed in the 'rendering' state and
+# returns, a small pool then renders the description, resolves the lexer
+# and warms the highlight cache off the request thread before swapping the
+# results in through the write queue. Posts left 'rendering' by a restart
+# are picked up again with `flask --app app.py render-pending`
+app.config['RENDER_WORKERS'] = 2
+render_pool = ThreadPoolExecutor(
+    max_workers=app.config['RENDER_WORKERS'], thread_name_prefix='render'
+)
+
+
+def write_render(yell_id, description, lexer):
+    post = db.session.execute(
+        db.select(Post).filter_by(base_yell_id=yell_id)
+    ).scalar_one()
+    post.post_description = description
+    post.post_lexer = lexer
+    post.post_state = 'ready'
+    index_yell(post.base_yell, post)
+    return post.post_content_id
+
+
+def render_post(yell_id, description, filename, source):
+    try:
+        description = render_markdown(description)
+        try:
+            lexer = resolve_lexer(filename, source).name
+        except ClassNotFound:
+            lexer = None
+        highlight_source(source, lexer)
+        highlight_source(post_excerpt(source), lexer)
+        store_code_blobs(
+            write_queue.submit(write_render, yell_id, description, lexer)
+        )
+    except Exception as error:
+        print(LOG, f'could not render yell {yell_id}: {error!r}', END)
+
+
+@app.cli.command('render-pending')
+def render_pending():
+    """Render every post still waiting in the 'rendering' state."""
+    posts = db.session.execute(
+        db.select(Post).filter_by(post_state='rendering')
+    ).scalars()
+    for post in list(posts):
+        render_post(
+            post.base_yell_id,
+            post.post_description,
+            strip_html(post.post_filename),
+            post.post_source,
+        )
+    print(LOG, 'pending posts rendered', END)
+
+
+# }}}
+# Rating aggregation{{{
+# Likes only touch their own rating row on the request path, and append the
+# matching yell_rating change to rating_delta_table in the same transaction.
+# A background thread folds the pending deltas into yell_table in one write
+# per interval, so a popular yell is not updated once per like. The deltas
+# are deleted in the transaction that applies them, so a fold that fails or
+# runs twice counts nothing twice, and the deltas of a worker that died are
+# folded by the next one. yell_rating can always be recounted from the
+# ratings with `flask --app app.py recount-ratings`
+app.config['RATING_FLUSH_INTERVAL'] = 1.0
+app.config['RATING_FLUSH_EVENTS'] = 1000
+
+
+class RatingAggregator:
+    def __init__(self):
+        self.lock = Lock()
+        self.wake = Event()
+        self.events = 0
+        self.flusher = WorkerThread(self.run)
+
+    def record(self):
+        with self.lock:
+            self.events += 1
+        self.flusher.start()
+        if self.events >= app.config['RATING_FLUSH_EVENTS']:
+            self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.wait(app.config['RATING_FLUSH_INTERVAL'])
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            events, self.events = self.events, 0
+        if not events:
+            return
+        try:
+            write_queue.submit(fold_ratings)
+        except Exception as error:
+            # The deltas are still in rating_delta_table for the next flush
+            print(LOG, f'rating flush failed: {error!r}', END)
+
+
+def fold_ratings():
+    # Deleting first takes the write lock, so the deltas summed are exactly
+    # the ones removed
+    pending = {}
+    for yell_id, delta in db.session.execute(
+        db.delete(RatingDelta).returning(
+            RatingDelta.original_yell_id, RatingDelta.rating_delta
+        )
+    ):
+        pending[yell_id] = pending.get(yell_id, 0) + delta
+    for yell_id, delta in sorted(pending.items()):
+        if not delta:
+            continue
+        db.session.execute(
+            db.update(Yell)
+            .filter_by(yell_id=yell_id)
+            .values(yell_rating=Yell.yell_rating + delta)
+        )
+        rank_yell(yell_id)
+
+
+rating_aggregator = RatingAggregator()
+atexit.register(rating_aggregator.flush)
+with app.app_context():
+    # Deltas left behind by a worker that stopped before folding them
+    fold_ratings()
+    db.session.commit()
+
+
+@app.cli.command('recount-ratings')
+def recount_ratings():
+    """Recount every yell_rating from the ratings and rebuild leaderboards."""
+    # The recount already includes every delta not folded yet
+    db.session.execute(db.delete(RatingDelta))
+    db.session.execute(
+        db.update(Yell).values(
+            yell_rating=db.select(db.func.count(Rating.rating_id))
+            .where(
+                Rating.original_yell_id == Yell.yell_id,
+                Rating.rating == True,
+            )
+            .scalar_subquery()
+        )
+    )
+    db.session.execute(db.delete(Leaderboard))
+    db.session.execute(db.delete(LeaderboardBuild))
+    db.session.commit()
+    print(LOG, 'ratings recounted', END)
+
+
 # }}}
 @app.route('/')  # {{{
 def index():
@@ -217,6 +1907,15 @@ def index():
     return render_template('index.html', current_user=current_user)
 
 
+# }}}
+def write_user(username, hash):  # {{{
+    return db.session.execute(
+        sqlite_insert(User)
+        .values(username=username, hash=hash)
+        .on_conflict_do_nothing()
+    ).rowcount
+
+
 # }}}
 @app.route('/register', methods=['GET', 'POST'])  # {{{
 def register():
@@ -266,10 +1965,16 @@ def register():
         if check:
             return send_error('That user already exists')
 
-        hash = bcrypt.generate_password_hash(password)
+        try:
+            hash = password_result(bcrypt.generate_password_hash, password)
+        except PasswordBusy:
+            return (
+                send_error('Too many sign ups right now, try again soon'),
+                503,
+            )
 
-        db.session.add(User(username=username, hash=hash))
-        db.session.commit()
+        if not write_queue.submit(write_user, username, hash):
+            return send_error('That user already exists')
 
         # elif current_user.is_anonymous:
         #     return render_template('register.html')
@@ -307,8 +2012,21 @@ def login():
         if not query:
             return send_error('That user does not exist')
         hash = query.hash
-        if not bcrypt.check_password_hash(hash, password):
-            return send_error('Wrong password')
+        try:
+            if not password_result(bcrypt.check_password_hash, hash, password):
+                return send_error('Wrong password')
+        except PasswordBusy:
+            return (
+                send_error('Too many logins right now, try again soon'),
+                503,
+            )
+        if hash_rounds(hash) != app.config['BCRYPT_LOG_ROUNDS']:
+            # Upgraded in the background, the next login tries again if
+            # the pool is busy
+            try:
+                password_work(rehash_password, query.id, password)
+            except PasswordBusy:
+                pass
 
         login_user(query)
         prev = request.form.get('prev')
@@ -370,6 +2088,46 @@ def create_menu():
     )
 
 
+# }}}
+def write_post(author_id, title, description, source, filename, tags):  # {{{
+    yell = Yell(
+        author_id=author_id,
+        yell_title=title,
+        yell_type='pst',
+    )
+    db.session.add(yell)
+    db.session.flush()
+
+    for tag in tags:
+        db.session.add(
+            Tag(
+                original_yell_id=yell.yell_id,
+                tag_content=tag,
+            )
+        )
+
+    post_lines, post_bytes = source_sizes(source)
+    content = Post(
+        base_yell_id=yell.yell_id,
+        post_description=description,
+        post_code='',
+        post_filename=filename,
+        post_source=source,
+        post_lines=post_lines,
+        post_bytes=post_bytes,
+        post_state='rendering',
+    )
+    # Indexed by write_render once the render pool is done with it
+    db.session.add(content)
+
+    db.session.add(
+        CommentSet(
+            original_yell_id=yell.yell_id,
+        )
+    )
+    return yell.yell_id
+
+
 # }}}
 @app.route('/create/post', methods=['GET', 'POST'])  # {{{
 @login_required
@@ -421,44 +2179,13 @@ def post():
         clean_title = clean_text(title)
         clean_filename = clean_text(filename)
 
-        clean_description = markdown(
-            clean(description),
-            extensions=[
-                codehilite(css_class='highlight', pygments_style='one-dark'),
-                fenced_code(),
-            ],
-        )
-
-        try:
-            lexer = guess_lexer_for_filename(filename, code)
-            clean_code = highlight(
-                code,
-                lexer,
-                HtmlFormatter(
-                    cssclass='highlight',
-                    style='one-dark',
-                    linenos='table',
-                    wrapcode=True,
-                ),
-            )
-        except:
-            clean_code = clean_text(code)
-
-        yell = Yell(
-            author_id=user_id,
-            yell_title=clean_title,
-            yell_type='pst',
-        )
-        db.session.add(yell)
-        db.session.flush()
-
+        cleaned_cleaned_tags = []
         if tags:
             cleaned_tags = {tag.strip() for tag in tags.split(',')}
             if len(cleaned_tags) > 10:
                 return send_error(
                     'Tags should not go above 10',
                 )
-            cleaned_cleaned_tags = []
             for tag in cleaned_tags:
                 if len(tag) > 30:
                     return send_error(
@@ -466,36 +2193,56 @@ def post():
                     )
                 cleaned_cleaned_tags.append(clean_text(tag))
 
-            for tag in cleaned_tags:
-                tag_db = Tag(
-                    original_yell_id=yell.yell_id,
-                    tag_content=tag,
-                )
-                db.session.add(tag_db)
-                db.session.flush()
+        yell_id = write_queue.submit(
+            write_post,
+            int(user_id),
+            clean_title,
+            description,
+            code,
+            clean_filename,
+            cleaned_cleaned_tags,
+        )
+        render_pool.submit(render_post, yell_id, description, filename, code)
 
-        db.session.add(
-            Post(
-                base_yell_id=yell.yell_id,
-                post_description=clean_description,
-                post_code=clean_code,
-                post_filename=clean_filename,
-            )
+        return redirect(url_for('index'))
+    else:
+        return render_template(
+            'post.html',
+            current_user=current_user,
         )
 
+
+# }}}
+def write_request(author_id, title, content, tags):  # {{{
+    yell = Yell(
+        author_id=author_id,
+        yell_title=title,
+        yell_type='req',
+    )
+    db.session.add(yell)
+    db.session.flush()
+
+    for tag in tags:
         db.session.add(
-            CommentSet(
+            Tag(
                 original_yell_id=yell.yell_id,
+                tag_content=tag,
             )
         )
-        db.session.commit()
 
-        return redirect(url_for('index'))
-    else:
-        return render_template(
-            'post.html',
-            current_user=current_user,
+    content = Request(
+        base_yell_id=yell.yell_id,
+        request_content=content,
+    )
+    db.session.add(content)
+    index_yell(yell, content)
+
+    db.session.add(
+        CommentSet(
+            original_yell_id=yell.yell_id,
         )
+    )
+    return yell.yell_id
 
 
 # }}}
@@ -532,32 +2279,18 @@ def req():
         elif not len(content) >= 3 or not len(content) <= 1000:
             return send_error(
                 'Description must be atleast 3 characters long and a maximum of 1000',
-            )
-
-        clean_title = clean_text(title)
-        clean_content = markdown(
-            clean(content),
-            extensions=[
-                codehilite(css_class='highlight', pygments_style='one-dark'),
-                fenced_code(),
-            ],
-        )
+            )
 
-        yell = Yell(
-            author_id=user_id,
-            yell_title=clean_title,
-            yell_type='req',
-        )
-        db.session.add(yell)
-        db.session.flush()
+        clean_title = clean_text(title)
+        clean_content = render_markdown(content)
 
+        cleaned_cleaned_tags = []
         if tags:
             cleaned_tags = {tag.strip() for tag in tags.split(',')}
             if len(cleaned_tags) > 10:
                 return send_error(
                     'Tags should not go above 10',
                 )
-            cleaned_cleaned_tags = []
             for tag in cleaned_tags:
                 if len(tag) > 30:
                     return send_error(
@@ -565,26 +2298,13 @@ def req():
                     )
                 cleaned_cleaned_tags.append(clean_text(tag))
 
-            for tag in cleaned_tags:
-                tag_db = Tag(
-                    original_yell_id=yell.yell_id,
-                    tag_content=tag,
-                )
-                db.session.add(tag_db)
-                db.session.flush()
-
-        db.session.add(
-            Request(
-                base_yell_id=yell.yell_id,
-                request_content=clean_content,
-            )
+        write_queue.submit(
+            write_request,
+            int(user_id),
+            clean_title,
+            clean_content,
+            cleaned_cleaned_tags,
         )
-        db.session.add(
-            CommentSet(
-                original_yell_id=yell.yell_id,
-            )
-        )
-        db.session.commit()
 
         return redirect(url_for('index'))
     else:
@@ -594,6 +2314,45 @@ def req():
         )
 
 
+# }}}
+def write_comment(author_id, original_yell_id, comment_set_id, content):  # {{{
+    db.session.execute(
+        db.update(Yell)
+        .filter_by(yell_id=original_yell_id)
+        .values(yell_comments=Yell.yell_comments + 1)
+    )
+
+    yell = Yell(
+        author_id=author_id,
+        yell_title='',
+        yell_type='com',
+    )
+    db.session.add(yell)
+    db.session.flush()
+
+    db.session.add(
+        CommentSet(
+            original_yell_id=yell.yell_id,
+        )
+    )
+    parent = db.session.execute(
+        db.select(Comment.comment_path, Comment.comment_depth).filter_by(
+            base_yell_id=original_yell_id
+        )
+    ).first()
+    path, depth = parent or (f'{original_yell_id:010d}/', 0)
+    db.session.add(
+        Comment(
+            base_yell_id=yell.yell_id,
+            comment_set_id=comment_set_id,
+            comment_content=content,
+            comment_path=path + f'{yell.yell_id:010d}/',
+            comment_depth=depth + 1,
+        )
+    )
+    return yell.yell_id
+
+
 # }}}
 # /<any(post, request, comment):yell_type>/<id>  {{{
 # Thanks cs50.ai for the route tricks
@@ -620,13 +2379,7 @@ def yell_page(yell_type, id):
             return send_error(
                 'Comments must be atleast 3 characters long and a maximum of 1000',
             )
-        comment = markdown(
-            clean(comment),
-            extensions=[
-                codehilite(css_class='highlight', pygments_style='one-dark'),
-                fenced_code(),
-            ],
-        )
+        comment = render_markdown(comment)
 
         match (yell_type):
             case 'post':
@@ -645,11 +2398,6 @@ def yell_page(yell_type, id):
                 'Something went wrong, please report this error, CODE: 3'
             )
 
-        db.session.execute(
-            db.update(Yell)
-            .filter_by(yell_id=data.base_yell_id)
-            .values(yell_comments=data.base_yell.yell_comments + 1)
-        )
         commentset = db.session.execute(
             db.select(CommentSet).filter_by(original_yell_id=data.base_yell_id)
         ).scalar()
@@ -658,28 +2406,13 @@ def yell_page(yell_type, id):
                 'Something went wrong, please report this error, CODE:2'
             )
 
-        yell = Yell(
-            author_id=user_id,
-            yell_title='',
-            yell_type='com',
-        )
-        db.session.add(yell)
-        db.session.flush()
-
-        db.session.add(
-            CommentSet(
-                original_yell_id=yell.yell_id,
-            )
+        write_queue.submit(
+            write_comment,
+            int(user_id),
+            data.base_yell_id,
+            commentset.comment_set_id,
+            comment,
         )
-        db.session.add(
-            Comment(
-                base_yell_id=yell.yell_id,
-                comment_set_id=commentset.comment_set_id,
-                comment_content=comment,
-            )
-        )
-
-        db.session.commit()
         return redirect(request.url)
 
     else:
@@ -688,6 +2421,44 @@ def yell_page(yell_type, id):
         )
 
 
+# }}}
+def write_rating(original_yell_id, critic_id, rate_type):  # {{{
+    # The per user state is switched with a single conditional statement and
+    # the yell_rating change is logged for fold_ratings
+    rated = dict(original_yell_id=original_yell_id, critic_id=critic_id)
+    if rate_type == 'like':
+        changed = db.session.execute(
+            db.update(Rating)
+            .filter_by(rating=False, **rated)
+            .values(rating=True)
+        ).rowcount
+        if not changed:
+            changed = db.session.execute(
+                sqlite_insert(Rating)
+                .values(rating=True, **rated)
+                .on_conflict_do_nothing()
+            ).rowcount
+        if not changed:
+            return 'already_liked', 0
+        db.session.add(
+            RatingDelta(original_yell_id=original_yell_id, rating_delta=1)
+        )
+        return 'yay', 1
+
+    changed = db.session.execute(
+        db.update(Rating).filter_by(rating=True, **rated).values(rating=False)
+    ).rowcount
+    if not changed:
+        rating = db.session.execute(
+            db.select(Rating).filter_by(**rated)
+        ).scalar()
+        return ('already_unliked' if rating else 'false_unlike'), 0
+    db.session.add(
+        RatingDelta(original_yell_id=original_yell_id, rating_delta=-1)
+    )
+    return 'yay', -1
+
+
 # }}}
 # /<any(post, request, comment):yell_type>/<id>/<rate_type>  {{{
 @app.route(
@@ -708,6 +2479,8 @@ def do_rate(yell_type, id, rate_type):
             data = db.session.get(Comment, id)
         case _:
             return '404'
+    if not data:
+        return '404'
     original_yell_id = data.base_yell_id
 
 
@@ -720,66 +2493,12 @@ def do_rate(yell_type, id, rate_type):
         return str(rating.rating)
 
 
-    rating = db.session.execute(
-        db.select(Rating).filter_by(
-            original_yell_id=original_yell_id, critic_id=int(critic_id)
-        )
-    ).scalar()
-    if not rating:
-        if rate_type == 'unlike':
-            return 'false_unlike'
-        elif rate_type == 'status':
-            return 'False'
-        rate_type == 'like'
-        new_rating = Rating(
-            original_yell_id=original_yell_id,
-            rating=True,
-            critic_id=(critic_id),
-        )
-        db.session.add(new_rating)
-        db.session.execute(
-            db.update(Yell)
-            .filter_by(yell_id=original_yell_id)
-            .values(yell_rating=Yell.yell_rating + 1)
-        )
-    else:
-        if rate_type == 'unlike':
-            match (rating.rating):
-                case False:
-                    return 'already_unliked'
-                case True:
-                    db.session.execute(
-                        db.update(Rating)
-                        .filter_by(
-                            original_yell_id=original_yell_id,
-                            critic_id=int(critic_id),
-                        )
-                        .values(rating=False)
-                    )
-                    db.session.execute(
-                        db.update(Yell)
-                        .filter_by(yell_id=original_yell_id)
-                        .values(yell_rating=Yell.yell_rating - 1)
-                    )
-        elif rate_type == 'like':
-            match (rating.rating):
-                case True:
-                    return 'already_liked'
-                case False:
-                    db.session.execute(
-                        db.update(Rating)
-                        .filter_by(
-                            original_yell_id=original_yell_id,
-                            critic_id=int(critic_id),
-                        )
-                        .values(rating=True)
-                    )
-                    db.session.execute(
-                        db.update(Yell)
-                        .filter_by(yell_id=original_yell_id)
-                        .values(yell_rating=Yell.yell_rating + 1)
-                    )
-    db.session.commit()
+    status, delta = write_queue.submit(
+        write_rating, original_yell_id, int(critic_id), rate_type
+    )
+    if not delta:
+        return status
+    rating_aggregator.record()
     return 'yay'
 
 
@@ -815,6 +2534,17 @@ def rate_status(yell_type, id):
     return str(rating.rating)
 
 
+# }}}
+def write_report(original_yell_id, report, reporter_id):  # {{{
+    db.session.add(
+        Report(
+            original_yell_id=original_yell_id,
+            report=report,
+            reporter_id=reporter_id,
+        )
+    )
+
+
 # }}}
 # /<any(post, request, comment):yell_type>/<id>/report  {{{
 @app.route(
@@ -858,9 +2588,9 @@ def report_yell(yell_type, id):
             )
         original_yell_id = data.base_yell_id
 
-        reported = Report(original_yell_id=original_yell_id,report=report,reporter_id=user_id)
-        db.session.add(reported)
-        db.session.commit()
+        write_queue.submit(
+            write_report, original_yell_id, report, int(user_id)
+        )
             
         return redirect(f"/{yell_type}/{id}")
     else:
@@ -907,6 +2637,15 @@ def report_yell(yell_type, id):
 #
 #
 # # }}}
+def write_mark(request_content_id):  # {{{
+    db.session.execute(
+        db.update(Request)
+        .filter_by(request_content_id=request_content_id)
+        .values(request_state=db.not_(Request.request_state))
+    )
+
+
+# }}}
 @app.route('/request/<id>/mark')   # {{{
 def mark_yell(id):
     critic_id = current_user.get_id()
@@ -920,19 +2659,96 @@ def mark_yell(id):
         return 'failed'
 
 
-    print(data.request_state)
-    print(not data.request_state)
-    shit = not data.request_state
-    db.session.execute(
-        db.update(Request)
-        .filter_by(request_content_id=data.request_content_id)
-        .values(request_state=shit)
-    )
-    db.session.commit()
+    write_queue.submit(write_mark, data.request_content_id)
 
     return redirect('/request/' + id)
 
 
+# }}}
+app.config['LIKED_MAX_IDS'] = 100
+
+
+def liked_yells(yell_ids):  # {{{
+    # The yells among yell_ids that the current user likes, in one query
+    critic_id = current_user.get_id()
+    if not critic_id or not yell_ids:
+        return set()
+    return set(
+        db.session.execute(
+            db.select(Rating.original_yell_id).where(
+                Rating.critic_id == int(critic_id),
+                Rating.original_yell_id.in_(yell_ids),
+                Rating.rating == True,
+            )
+        ).scalars()
+    )
+
+
+# }}}
+@app.route('/api/liked')  # {{{
+def get_liked():
+    # Whether the current user likes each of ?ids=1,2,3, a page of cards
+    # at a time instead of one /status request per card
+    try:
+        yell_ids = [int(i) for i in request.args.get('ids', '').split(',')]
+    except ValueError:
+        return '404'
+    yell_ids = yell_ids[: app.config['LIKED_MAX_IDS']]
+    liked = liked_yells(yell_ids)
+    return jsonify({yell_id: yell_id in liked for yell_id in yell_ids})
+
+
+# }}}
+def yell_card(base, content, preview=False):  # {{{
+    if current_user.is_authenticated == False:
+        owned = False
+    else:
+        owned = base.author_id == int(current_user.get_id())
+    card = dict(
+        base_id=base.yell_id,
+        base_title=base.yell_title,
+        base_rating=base.yell_rating,
+        base_comments=base.yell_comments,
+        base_datetime=base.yell_datetime.isoformat(),
+        base_type=base.yell_type,
+        author=yell_author(base),
+        owned=owned,
+    )
+    match (base.yell_type):
+        case 'pst':
+            description = content.post_description
+            if content.post_state == 'rendering':
+                # Still the markdown as typed, and the code has no lexer yet
+                description = clean_text(description)
+            if preview:
+                code, truncated = preview_post(content)
+            else:
+                code, truncated = highlight_post(content), False
+            card.update(
+                content_id=content.post_content_id,
+                post_code=code,
+                post_truncated=truncated,
+                post_lines=content.post_lines,
+                post_bytes=content.post_bytes,
+                post_description=description,
+                post_filename=content.post_filename,
+                post_state=content.post_state,
+            )
+        case 'req':
+            card.update(
+                content_id=content.request_content_id,
+                request_content=content.request_content,
+                request_state=content.request_state,
+            )
+        case 'com':
+            card.update(
+                content_id=content.comment_id,
+                comment_set_id=content.comment_set_id,
+                comment_content=content.comment_content,
+            )
+    return card
+
+
 # }}}
 @app.route('/api/yell/<yell_id>')  # {{{
 def get_yell(yell_id):
@@ -941,9 +2757,9 @@ def get_yell(yell_id):
             db.select(Yell).order_by(Yell.yell_id.desc())
         ).scalar()
     elif yell_id == 'rated':
-        base = db.session.execute(
-            db.select(Yell).order_by(Yell.yell_rating.desc())
-        ).scalar()
+        base = None
+        for rated_id in top_rated('all', 'all', 1):
+            base = db.session.get(Yell, rated_id)
     else:
         base = db.session.get(Yell, yell_id)
 
@@ -972,7 +2788,9 @@ def get_post(post_id):
         ).scalar()
     elif post_id == 'rated':
         post = db.session.execute(
-            db.select(Post).order_by(Post.base_yell.rating.desc())
+            db.select(Post).where(
+                Post.base_yell_id.in_(top_rated('pst', 'all', 1))
+            )
         ).scalar()
     else:
         post = db.session.get(Post, post_id)
@@ -983,25 +2801,36 @@ def get_post(post_id):
     if not post:
         return '404'
 
-    base = post.base_yell
-    if current_user.is_authenticated == False:
-        owned = False
-    else:
-        owned = base.author.id == int(current_user.get_id())
+    return jsonify(yell_card(post.base_yell, post))
 
-    return jsonify(
-        base_id=base.yell_id,
-        base_title=base.yell_title,
-        base_rating=base.yell_rating,
-        base_comments=base.yell_comments,
-        base_datetime=base.yell_datetime.isoformat(),
-        base_type=base.yell_type,
-        author=base.author.username,
-        owned=owned,
-        content_id=post.post_content_id,
-        post_code=post.post_code,
-        post_description=post.post_description,
-        post_filename=post.post_filename,
+
+# }}}
+@app.route('/api/post/<post_id>/code')  # {{{
+def get_post_code(post_id):
+    # The full code of a card that was sent as a preview
+    post = db.session.get(Post, post_id)
+    if not post:
+        return '404'
+    style = app.config['PYGMENTS_STYLE']
+    encoding = request.accept_encodings.best_match(content_encodings)
+    blob = encoding and db.session.execute(
+        db.select(CodeBlob.blob_data).filter_by(
+            post_content_id=post.post_content_id,
+            blob_style=style,
+            blob_encoding=encoding,
+        )
+    ).scalar()
+    if blob:
+        response = app.response_class(blob, mimetype='application/json')
+        response.headers['Content-Encoding'] = encoding
+        return response
+    key = (post.post_content_id, style)
+    if post.post_state == 'ready' and key not in code_blobs_pending:
+        # Older posts and new styles get their blobs on first request
+        code_blobs_pending.add(key)
+        render_pool.submit(store_code_blobs, post.post_content_id)
+    return app.response_class(
+        post_code_json(post), mimetype='application/json'
     )
 
 
@@ -1018,7 +2847,9 @@ def get_request(request_id):
         print(LOG, 'if get_request', req, END)
     elif request_id == 'rated':
         req = db.session.execute(
-            db.select(Request).order_by(Request.base_yell.rating.desc())
+            db.select(Request).where(
+                Request.base_yell_id.in_(top_rated('req', 'all', 1))
+            )
         ).scalar()
         print(LOG, 'elif get_request', req, END)
     else:
@@ -1031,25 +2862,7 @@ def get_request(request_id):
     if not req:
         return '404'
 
-    base = req.base_yell
-
-    if current_user.is_authenticated == False:
-        owned = False
-    else:
-        owned = base.author.id == int(current_user.get_id())
-    return jsonify(
-        base_id=base.yell_id,
-        base_title=base.yell_title,
-        base_rating=base.yell_rating,
-        base_comments=base.yell_comments,
-        base_datetime=base.yell_datetime.isoformat(),
-        base_type=base.yell_type,
-        author=base.author.username,
-        owned=owned,
-        content_id=req.request_content_id,
-        request_content=req.request_content,
-        request_state=req.request_state,
-    )
+    return jsonify(yell_card(req.base_yell, req))
 
 
 # }}}
@@ -1083,24 +2896,235 @@ def get_comment(comment_id):
         if not comment:
             return '404'
 
-    base = comment.base_yell
+    return jsonify(yell_card(comment.base_yell, comment))
 
-    if current_user.is_authenticated == False:
-        owned = False
-    else:
-        owned = base.author.id == int(current_user.get_id())
+
+# }}}
+def thread_card(comment, cards):  # {{{
+    card = yell_card(comment.base_yell, comment)
+    card['replies'] = []
+    cards[comment.base_yell_id] = card
+    return card
+
+
+# }}}
+def subtree_sizes(yell_ids):  # {{{
+    # How many comments are below each of the comments, in one query
+    below = aliased(Comment)
+    return dict(
+        db.session.execute(
+            db.select(Comment.base_yell_id, db.func.count(below.comment_id))
+            .join(
+                below,
+                db.and_(
+                    below.comment_path > Comment.comment_path,
+                    below.comment_path < Comment.comment_path + ':',
+                ),
+            )
+            .where(Comment.base_yell_id.in_(yell_ids))
+            .group_by(Comment.base_yell_id)
+        ).all()
+    )
+
+
+# }}}
+app.config['THREAD_PAGE_SIZE'] = 20
+app.config['THREAD_MAX_DEPTH'] = 3
+app.config['THREAD_REPLIES'] = 3
+
+
+@app.route('/api/thread/<int:yell_id>')  # {{{
+def get_thread(yell_id):
+    # A page of the comments on a yell, oldest first, with their authors
+    # joined in. depth=n nests up to THREAD_REPLIES replies per comment, n
+    # levels deep, in one more query. The cursor is the last comment_id
+    page_size = app.config['THREAD_PAGE_SIZE']
+    limit = max(1, min(request.args.get('limit', page_size, type=int), 50))
+    depth = min(
+        request.args.get('depth', 0, type=int), app.config['THREAD_MAX_DEPTH']
+    )
+    cursor = request.args.get('cursor')
+    select = (
+        db.select(Comment, CommentSet.original_yell_id)
+        .join(Comment.base_yell)
+        .join(CommentSet, CommentSet.comment_set_id == Comment.comment_set_id)
+        .options(contains_eager(Comment.base_yell))
+        .order_by(Comment.comment_id)
+    )
+    page = select.where(CommentSet.original_yell_id == yell_id).limit(limit)
+    if cursor:
+        try:
+            after = int(urlsafe_b64decode(cursor))
+        except ValueError:
+            return '404'
+        page = page.where(Comment.comment_id > after)
+    comments = db.session.execute(page).all()
+    cache_users(comment.base_yell.author_id for comment, _ in comments)
+
+    cards = {}
+    thread = []
+    for comment, _ in comments:
+        thread.append(thread_card(comment, cards))
+    if depth and comments:
+        # The first replies of every comment on the page, down to depth,
+        # numbered per comment set. The subtrees of consecutive comments
+        # are one range of comment_path, parents sorting before replies
+        first, last = comments[0][0], comments[-1][0]
+        position = (
+            db.func.row_number()
+            .over(
+                partition_by=Comment.comment_set_id,
+                order_by=Comment.comment_id,
+            )
+            .label('position')
+        )
+        replies = (
+            db.select(Comment.comment_id, position)
+            .where(
+                Comment.comment_path > first.comment_path,
+                Comment.comment_path < last.comment_path + ':',
+                Comment.comment_depth > first.comment_depth,
+                Comment.comment_depth <= first.comment_depth + depth,
+            )
+            .subquery()
+        )
+        nested = db.session.execute(
+            select.join(replies, replies.c.comment_id == Comment.comment_id)
+            .where(replies.c.position <= app.config['THREAD_REPLIES'])
+            .order_by(None)
+            .order_by(Comment.comment_path)
+        ).all()
+        cache_users(comment.base_yell.author_id for comment, _ in nested)
+        for comment, original_yell_id in nested:
+            # Replies of replies that did not make the cut are left out
+            if original_yell_id in cards:
+                cards[original_yell_id]['replies'].append(
+                    thread_card(comment, cards)
+                )
+
+    liked = liked_yells(list(cards))
+    sizes = subtree_sizes(list(cards))
+    for yell_id, card in cards.items():
+        card['liked'] = yell_id in liked
+        card['thread_replies'] = sizes.get(yell_id, 0)
+
+    next = None
+    if len(comments) == limit:
+        next = urlsafe_b64encode(
+            str(comments[-1][0].comment_id).encode()
+        ).decode()
+    return jsonify(comments=thread, next=next)
+
+
+# }}}
+@app.route('/api/thread/<int:yell_id>/ancestors')  # {{{
+def get_ancestors(yell_id):
+    # The comments a comment replies to, outermost first, in one query on
+    # the yell ids of its path. root_yell_id is the post or request
+    path = db.session.execute(
+        db.select(Comment.comment_path).filter_by(base_yell_id=yell_id)
+    ).scalar()
+    if not path:
+        return '404'
+    root_yell_id, *ancestors, _ = [int(i) for i in path.split('/') if i]
+    comments = (
+        db.session.execute(
+            db.select(Comment)
+            .join(Comment.base_yell)
+            .options(contains_eager(Comment.base_yell))
+            .where(Comment.base_yell_id.in_(ancestors))
+            .order_by(Comment.comment_path)
+        )
+        .scalars()
+        .all()
+    )
+    cache_users(comment.base_yell.author_id for comment in comments)
     return jsonify(
-        base_id=base.yell_id,
-        base_title=base.yell_title,
-        base_rating=base.yell_rating,
-        base_comments=base.yell_comments,
-        base_datetime=base.yell_datetime.isoformat(),
-        base_type=base.yell_type,
-        author=base.author.username,
-        owned=owned,
-        content_id=comment.comment_id,
-        comment_set_id=comment.comment_set_id,
-        comment_content=comment.comment_content,
+        root_yell_id=root_yell_id,
+        comments=[yell_card(c.base_yell, c) for c in comments],
+    )
+
+
+# }}}
+@app.route('/api/cards/<any(post, request):yell_type>')  # {{{
+# @login_required
+def get_cards(yell_type):
+    # A page of the feed, newest first, built from one query per table
+    # instead of three requests per card. The cursor is the last yell_id
+    # seen, so every page is an index range scan on ix_yell_type_id.
+    # preview=1 cuts the code of posts down to their first lines
+    limit = max(1, min(request.args.get('limit', 15, type=int), 50))
+    cursor = request.args.get('cursor')
+    preview = request.args.get('preview', 0, type=int) == 1
+    match (yell_type):
+        case 'post':
+            content_type, type_code = Post, 'pst'
+        case 'request':
+            content_type, type_code = Request, 'req'
+    select = (
+        db.select(content_type)
+        .join(content_type.base_yell)
+        .options(contains_eager(content_type.base_yell))
+        .where(Yell.yell_type == type_code)
+        .order_by(Yell.yell_id.desc())
+        .limit(limit)
+    )
+    if cursor:
+        try:
+            after = int(urlsafe_b64decode(cursor))
+        except ValueError:
+            return '404'
+        select = select.where(Yell.yell_id < after)
+    contents = db.session.execute(select).scalars().all()
+    yell_ids = [content.base_yell_id for content in contents]
+    cache_users(content.base_yell.author_id for content in contents)
+
+    tags = {}
+    for original_yell_id, tag_content in db.session.execute(
+        db.select(Tag.original_yell_id, Tag.tag_content).where(
+            Tag.original_yell_id.in_(yell_ids)
+        )
+    ):
+        tags.setdefault(original_yell_id, []).append(tag_content)
+
+    liked = liked_yells(yell_ids)
+    cards = []
+    for content in contents:
+        card = yell_card(content.base_yell, content, preview)
+        card['tags'] = tags.get(content.base_yell_id, [])
+        card['liked'] = content.base_yell_id in liked
+        cards.append(card)
+
+    next = None
+    if len(contents) == limit:
+        next = urlsafe_b64encode(str(yell_ids[-1]).encode()).decode()
+    return jsonify(cards=cards, next=next)
+
+
+# }}}
+@app.route(
+    '/api/leaderboard/<any(yell, post, request, comment):yell_type>'
+    '/<any(day, week, all):window>'
+)  # {{{
+def get_leaderboard(yell_type, window):
+    board_type = {
+        'yell': 'all',
+        'post': 'pst',
+        'request': 'req',
+        'comment': 'com',
+    }[yell_type]
+    return jsonify(top_rated(board_type, window))
+
+
+# }}}
+@app.route('/api/stats/caches')  # {{{
+def get_cache_stats():
+    # Hit and miss counters of this process' caches, for sizing them
+    return jsonify(
+        user=user_cache.stats(),
+        markdown=markdown_cache.stats(),
+        highlight=highlight_cache.stats(),
+        search=search_corpus.stats(),
     )
 
 
@@ -1123,78 +3147,87 @@ def get_tags(yell_id):
 @sock.route('/api/yell/search/<searched>')  # {{{
 # @login_required
 def get_yell_multi(ws, searched):
-    all = db.session.execute(db.select(Yell)).scalars().all()
-    threshold = 80
-    temp_dict = {}
-    for idx, query in enumerate(all, 1):
-        if len(temp_dict) >= 15:
-
-            send_temp_dict(ws, temp_dict)
-            temp_dict = {}
+    ranked = search_ranked(searched, search_mode())
+    # Nothing else is read, so give the connection back while waiting
+    db.session.close()
+    page_size = app.config['SEARCH_PAGE_SIZE']
+    for start in range(0, len(ranked), page_size):
+        if start:
             while True:
                 data = ws.receive()
                 if data == 'next':
                     break
-
-        temp_dict[query.yell_id] = 0
-
-        match (query.yell_type):
-            case 'pst':
-                post = db.session.execute(
-                    db.select(Post).filter_by(base_yell_id=query.yell_id)
-                ).scalar()
-                if not post:
-                    return '404'
-                eval = [
-                    post.post_description,
-                    post.post_code,
-                    post.post_filename,
-                    query.author.username,
-                    query.yell_datetime,
-                    query.yell_rating,
-                    query.yell_title,
-                ]
-            case 'req':
-                req = db.session.execute(
-                    db.select(Request).filter_by(base_yell_id=query.yell_id)
-                ).scalar()
-                if not req:
-                    return '404'
-                eval = [
-                    req.request_content,
-                    query.author.username,
-                    query.yell_datetime,
-                    query.yell_rating,
-                    query.yell_title,
-                ]
-            case 'com':
-                # TODO: maybe implement
-                continue
-            case _:
-                continue
-
-        for idx, item in enumerate(eval):
-            ratio = fuzz.WRatio(
-                str(searched), str(item), processor=utils.default_process
-            )
-            temp_dict[query.yell_id] += ratio * idx
-        temp_dict[query.yell_id] /= len(eval)
-        if temp_dict[query.yell_id] < threshold:
-            temp_dict.pop(query.yell_id)
-    send_temp_dict(ws, temp_dict)
+        for result in ranked[start : start + page_size]:
+            ws.send(result)
     ws.send('404')
 
 
-def send_temp_dict(ws, temp_dict):
-    temp_dict = dict(
-        sorted(
-            temp_dict.items(),
-            key=lambda item: item[1],
-            reverse=True,
+# }}}
+def write_search_session(token, results, now):  # {{{
+    idle = timedelta(seconds=app.config['SEARCH_SESSION_IDLE'])
+    db.session.execute(
+        db.delete(SearchSession).where(SearchSession.session_used < now - idle)
+    )
+    db.session.add(
+        SearchSession(
+            session_token=token, session_results=results, session_used=now
         )
     )
-    for result in temp_dict:
-        ws.send(result)
+
+
+def write_session_used(token, now):
+    db.session.execute(
+        db.update(SearchSession)
+        .filter_by(session_token=token)
+        .values(session_used=now)
+    )
+
+
+# }}}
+def search_results_page(token, page, ranked):  # {{{
+    page_size = app.config['SEARCH_PAGE_SIZE']
+    return jsonify(
+        token=token,
+        page=page,
+        results=ranked[page * page_size : (page + 1) * page_size],
+        next=(page + 1) * page_size < len(ranked),
+    )
+
+
+# }}}
+@app.route('/api/search')  # {{{
+# @login_required
+def start_search():
+    ranked = search_ranked(request.args.get('q', ''), search_mode())
+    token = token_urlsafe()
+    # Waited on, so the next page can already be read back
+    write_queue.submit(
+        write_search_session,
+        token,
+        ','.join(map(str, ranked)),
+        datetime.utcnow(),
+    )
+    return search_results_page(token, 0, ranked)
+
+
+@app.route('/api/search/<token>/<int:page>')
+# @login_required
+def search_page(token, page):
+    now = datetime.utcnow()
+    idle = timedelta(seconds=app.config['SEARCH_SESSION_IDLE'])
+    session = db.session.get(SearchSession, token)
+    if not session or now - session.session_used > idle:
+        return '404'
+    # Only written again once a tenth of the idle window has gone by
+    if now - session.session_used > idle / 10:
+        write_queue.defer(write_session_used, token, now)
+
+    ranked = [
+        int(yell_id)
+        for yell_id in session.session_results.split(',')
+        if yell_id
+    ]
+    return search_results_page(token, page, ranked)
 
 
 # }}}
@@ -5,9 +5,11 @@ async function get_api(id, type = "yell") {
 	return result.json();
 }
 
-async function append_tags(title, id) {
-	const tags = await get_api(id, "tags");
-	if (tags == "404") {
+async function append_tags(title, json) {
+	// Feed cards come with their tags, single cards fetch them
+	const tags =
+		"tags" in json ? json["tags"] : await get_api(json["base_id"], "tags");
+	if (tags == "404" || tags.length == 0) {
 		return "404";
 	}
 	title.innerHTML += "<br><br>Tags: ";
@@ -137,7 +139,7 @@ function create_post_card(json) {
 	const description_content_body = document.createElement("div");
 	description_content_body.className = "accordion-body";
 	description_content_body.innerHTML = json["post_description"];
-	append_tags(description_content_body, post_id);
+	append_tags(description_content_body, json);
 	description_content.appendChild(description_content_body);
 	description.appendChild(description_content);
 	accordion.appendChild(description);
@@ -168,7 +170,26 @@ function create_post_card(json) {
 	const code_content_copy = document.createElement("button");
 	code_content_copy.className = "card position-absolute top-0 end-0 pb-1 m-1";
 	code_content_copy.innerHTML = "Copy";
-	code_content_copy.onclick = () => {
+
+	// Feed cards only come with the first lines of the code
+	var truncated = json["post_truncated"] == true;
+	const code_content_expand = document.createElement("button");
+	code_content_expand.className = "btn btn-link w-100";
+	code_content_expand.innerHTML = `Show all ${json["post_lines"]} lines`;
+	async function expand() {
+		if (!truncated) {
+			return;
+		}
+		truncated = false;
+		const full = await get_api(`${post_id}/code`, "post");
+		code_content_body.innerHTML = full["post_code"];
+		code_content_body.appendChild(code_content_copy);
+		code_content_expand.remove();
+	}
+	code_content_expand.onclick = expand;
+
+	code_content_copy.onclick = async () => {
+		await expand();
 		navigator.clipboard.writeText(
 			code_content_body.getElementsByClassName("code")[0].textContent,
 		);
@@ -180,6 +201,9 @@ function create_post_card(json) {
 
 	code_content_body.appendChild(code_content_copy);
 	code_content.appendChild(code_content_body);
+	if (truncated) {
+		code_content.appendChild(code_content_expand);
+	}
 	code.appendChild(code_content);
 	accordion.appendChild(code);
 	card.appendChild(accordion);
@@ -244,7 +268,7 @@ function create_request_card(json) {
 	const body_content_body = document.createElement("div");
 	body_content_body.className = "accordion-body overflow-scroll";
 	body_content_body.innerHTML = json["request_content"];
-	append_tags(body_content_body, request_id);
+	append_tags(body_content_body, json);
 
 	body_content.appendChild(body_content_body);
 	body.appendChild(body_content);
@@ -353,10 +377,15 @@ async function start_like_classes(like, json) {
 			badge_add();
 		}
 	};
-	const status = await fetch(
-		`/${json["base_type"]}/${json["content_id"]}/status`,
-	);
-	const status_data = await status.text();
+	var status_data;
+	if ("liked" in json) {
+		status_data = json["liked"] ? "True" : "False";
+	} else {
+		const status = await fetch(
+			`/${json["base_type"]}/${json["content_id"]}/status`,
+		);
+		status_data = await status.text();
+	}
 	// console.log(status_data, json);
 	switch (status_data) {
 		case "True":
@@ -403,15 +432,33 @@ function create_footer(json) {
 	return footer;
 }
 //}}}
-async function add_card_byid(id, type = "yell", div = main) {
+async function get_liked(ids) {
+	// Like states of a page of yells in one request
+	if (ids.length == 0) {
+		return {};
+	}
+	const result = await fetch(`/api/liked?ids=${ids.join(",")}`);
+	return result.json();
+}
+
+async function add_card_byid(id, type = "yell", div = main, liked) {
 	// console.log("request for post", id);{{{
 	const get = await get_api(id, type);
 	if (get == "404") {
 		console.log("failed request for post", id, type);
 		return "404";
 	}
-	// console.log(get);
-	type = get["base_type"];
+	if (liked != undefined) {
+		get["liked"] = liked;
+	}
+	return add_card(get, div);
+
+	// console.log("completed request for post", id);
+}
+//}}}
+function add_card(get, div = main) {
+	// console.log(get);{{{
+	var type = get["base_type"];
 	// console.log(type);
 	switch (type) {
 		case "pst":
@@ -438,8 +485,6 @@ async function add_card_byid(id, type = "yell", div = main) {
 	card.appendChild(footer);
 	div.appendChild(card);
 	return;
-
-	// console.log("completed request for post", id);
 }
 //}}}
 async function wait_for_scroll() {
@@ -471,15 +516,25 @@ async function main_func(type) {
 		warn.innerHTML = "No more results";
 	}
 
-	const get = await get_api("last", type);
-
-	for (var index = get["content_id"]; index > 0; index--) {
-		if (index % 15 == 0) {
+	// Each page hands back the cursor of the next one, null after the last
+	var cursor = "";
+	while (cursor != null) {
+		const result = await fetch(
+			`/api/cards/${type}?preview=1&cursor=${cursor}`,
+		);
+		const page = await result.json();
+		if (page == "404") {
+			break;
+		}
+		for (var index = 0; index < page["cards"].length; index++) {
+			add_card(page["cards"][index]);
+		}
+		cursor = page["next"];
+		if (cursor != null) {
 			await wait_for_scroll();
 		}
-		add_card_byid(index, type);
 	}
 	stop_spinner();
 }
 
-export { get_api, add_card_byid, main_func };
+export { get_api, get_liked, add_card, add_card_byid, main_func };
@@ -1,4 +1,4 @@
-import { add_card_byid } from "./discover.js";
+import { add_card_byid, get_liked } from "./discover.js";
 
 const warn = document.getElementById("warn");
 const spinner = document.getElementById("spinner");
@@ -14,33 +14,50 @@ function stop_spinner() {
 }
 
 const query = document.getElementById("searchup").dataset["query"];
-// const next = document.getElementById("next");
-const socket = new WebSocket(
-	"ws://" + location.host + "/api/yell/search/" + query,
-);
+var token = null;
+var page = 0;
 
-socket.addEventListener("message", (ev) => {
-	// console.log(ev.data);
-	if (ev.data == "404") {
+async function next_page() {
+	// The first request ranks the results once, the rest just page through them
+	const url =
+		token == null
+			? "/api/search?q=" + encodeURIComponent(query)
+			: `/api/search/${token}/${page}`;
+	const result = await (await fetch(url)).json();
+	if (result == "404") {
 		stop_spinner();
-		socket.removeEventListener("message", self);
-		return "shitass";
+		return false;
 	}
-	// console.log(ev.data);
-	add_card_byid(ev.data);
-});
+	token = result["token"];
+	page = result["page"] + 1;
+	const liked = await get_liked(result["results"]);
+	for (var index = 0; index < result["results"].length; index++) {
+		const id = result["results"][index];
+		add_card_byid(id, "yell", undefined, liked[id]);
+	}
+	if (!result["next"]) {
+		stop_spinner();
+		return false;
+	}
+	return true;
+}
 
-async function handle_websocket_infinite_scroll() {
-	window.removeEventListener("scroll", handle_websocket_infinite_scroll);
+async function handle_infinite_scroll() {
+	window.removeEventListener("scroll", handle_infinite_scroll);
 	const offset = 100;
 	const endOfPage =
 		window.innerHeight + window.scrollY >= document.body.offsetHeight - offset;
 
 	// console.log(endOfPage);
 	if (endOfPage) {
-		socket.send("next");
+		if (!(await next_page())) {
+			return;
+		}
 		await new Promise((r) => setTimeout(r, 500));
 	}
-	window.addEventListener("scroll", handle_websocket_infinite_scroll);
+	window.addEventListener("scroll", handle_infinite_scroll);
+}
+
+if (await next_page()) {
+	window.addEventListener("scroll", handle_infinite_scroll);
 }
-window.addEventListener("scroll", handle_websocket_infinite_scroll);
@@ -1,26 +1,56 @@
-import { add_card_byid, get_api } from "./discover.js";
+import { add_card, add_card_byid, get_api } from "./discover.js";
+
+function add_thread(comments, div) {
+	// Replies come nested under their comment, indented one step per level
+	for (var index = 0; index < comments.length; index++) {
+		add_card(comments[index], div);
+		if (comments[index]["replies"].length > 0) {
+			const replies = document.createElement("div");
+			replies.className = "ms-4";
+			add_thread(comments[index]["replies"], replies);
+			div.appendChild(replies);
+		}
+	}
+}
 
 async function add_comments(id, yell_type, spinner, div) {
 	const orig = await get_api(id, yell_type);
-	const orig_id = orig["base_id"];
-
-	const comment_set = await get_api(orig_id, "commentset");
-
-	if (orig == "404" || comment_set == "404") {
+	if (orig == "404") {
 		spinner.innerHTML = "Could not load this right now.";
 		return;
 	}
+
 	const container = document.createElement("div");
-	for (var index = 0; index < comment_set.comments.length; index++) {
-		add_card_byid(
-			comment_set.comments[index]["comment_id"],
-			"comment",
-			container,
+	const more = document.createElement("button");
+	more.className = "btn btn-link w-100";
+	more.innerHTML = "Load more comments";
+
+	// Top level comments come a page at a time, the "Load more" button
+	// stays until /api/thread answers with no next cursor
+	var cursor = "";
+	async function next_page() {
+		const result = await fetch(
+			`/api/thread/${orig["base_id"]}?depth=1&cursor=${cursor}`,
 		);
+		const page = await result.json();
+		if (page == "404") {
+			spinner.innerHTML = "Could not load this right now.";
+			return;
+		}
+		add_thread(page["comments"], container);
+		cursor = page["next"];
+		if (cursor == null) {
+			more.remove();
+		}
 	}
+	more.onclick = next_page;
 
+	await next_page();
 	spinner.remove();
-	return div.appendChild(container);
+	div.appendChild(container);
+	if (cursor != null) {
+		div.appendChild(more);
+	}
 }
 
 async function spinner_replace(id, yell_type, spinner, div) {
@@ -0,0 +1,63 @@
+"""Reports bytes on the wire and CPU time per request for the full code of a
+large post, compressed per request on /api/post/<id> and served from the
+stored blobs on /api/post/<id>/code, for every encoding available.
+
+    python tests/bench_compression.py [requests]
+"""
+
+import os
+import sys
+import tempfile
+from time import process_time
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+    tempfile.mkdtemp(), 'app.db'
+)
+os.environ['WRITE_QUEUE'] = 'off'
+os.environ.setdefault('SECRET_KEY', 'bench')
+os.environ.setdefault('SECURITY_PASSWORD_SALT', 'bench')
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from app import (
+    app,
+    db,
+    User,
+    Post,
+    content_encodings,
+    render_post,
+    write_post,
+    write_queue,
+)
+
+REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+# The app itself makes a suitably large snippet
+with open(os.path.join(root, 'app.py')) as file:
+    source = file.read()
+
+with app.app_context():
+    db.session.add(User(id=1, username='bench', hash='-'))
+    db.session.commit()
+yell_id = write_queue.submit(
+    write_post, 1, 'bench', 'bench', source, 'app.py', []
+)
+render_post(yell_id, 'bench', 'app.py', source)
+with app.app_context():
+    post_id = db.session.execute(
+        db.select(Post.post_content_id).filter_by(base_yell_id=yell_id)
+    ).scalar()
+
+client = app.test_client()
+print(f'{len(source)} bytes of source, {REQUESTS} requests each')
+print(f'{"endpoint":<24}{"encoding":<10}{"bytes":>10}{"cpu ms":>10}')
+for name, url in (
+    ('per request', f'/api/post/{post_id}'),
+    ('stored', f'/api/post/{post_id}/code'),
+):
+    for encoding in ['identity'] + content_encodings:
+        start = process_time()
+        for _ in range(REQUESTS):
+            response = client.get(url, headers={'Accept-Encoding': encoding})
+        cpu = (process_time() - start) / REQUESTS * 1000
+        print(f'{name:<24}{encoding:<10}{len(response.data):>10}{cpu:>10.2f}')
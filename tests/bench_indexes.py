@@ -0,0 +1,155 @@
+"""Times the lookups of the hot paths on a seeded database, first with only
+the primary keys and then with the indexes declared on the models.
+
+    python tests/bench_indexes.py [yells]
+"""
+
+import os
+import sys
+import random
+import tempfile
+from time import perf_counter
+
+path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{path}'
+os.environ.setdefault('SECRET_KEY', 'bench')
+os.environ.setdefault('SECURITY_PASSWORD_SALT', 'bench')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import (
+    app,
+    db,
+    User,
+    Yell,
+    Post,
+    Request,
+    CommentSet,
+    Comment,
+    Tag,
+    Rating,
+)
+
+YELLS = int(sys.argv[1]) if len(sys.argv) > 1 else 60000
+USERS = 1000
+LOOKUPS = 200
+
+
+def seed():  # {{{
+    insert = lambda model, rows: db.session.execute(db.insert(model), rows)
+    insert(
+        User,
+        [
+            {'id': i, 'username': f'user{i}', 'hash': '-'}
+            for i in range(1, USERS + 1)
+        ],
+    )
+    yells, posts, requests, sets, comments, tags, ratings = (
+        [] for _ in range(7)
+    )
+    for yell_id in range(1, YELLS + 1):
+        yell_type = ('pst', 'req', 'com')[yell_id % 3]
+        yells.append(
+            {
+                'yell_id': yell_id,
+                'author_id': random.randint(1, USERS),
+                'yell_title': f'title {yell_id}',
+                'yell_type': yell_type,
+                'yell_rating': random.randint(0, 500),
+            }
+        )
+        sets.append({'comment_set_id': yell_id, 'original_yell_id': yell_id})
+        match (yell_type):
+            case 'pst':
+                posts.append(
+                    {
+                        'base_yell_id': yell_id,
+                        'post_description': 'description',
+                        'post_code': 'code',
+                        'post_filename': 'bench.py',
+                    }
+                )
+            case 'req':
+                requests.append(
+                    {'base_yell_id': yell_id, 'request_content': 'body'}
+                )
+            case 'com':
+                comments.append(
+                    {
+                        'base_yell_id': yell_id,
+                        'comment_set_id': random.randint(1, yell_id - 1),
+                        'comment_content': 'comment',
+                    }
+                )
+        tags += [
+            {'original_yell_id': yell_id, 'tag_content': f'tag{i}'}
+            for i in range(2)
+        ]
+        ratings += [
+            {
+                'original_yell_id': yell_id,
+                'critic_id': critic_id,
+                'rating': True,
+            }
+            for critic_id in random.sample(range(1, USERS + 1), 3)
+        ]
+    for model, rows in (
+        (Yell, yells),
+        (Post, posts),
+        (Request, requests),
+        (CommentSet, sets),
+        (Comment, comments),
+        (Tag, tags),
+        (Rating, ratings),
+    ):
+        insert(model, rows)
+    db.session.commit()
+
+
+# }}}
+lookups = {
+    'get_post': lambda i: db.select(Post).filter_by(base_yell_id=i),
+    'get_request': lambda i: db.select(Request).filter_by(base_yell_id=i),
+    'get_comment': lambda i: db.select(Comment).filter_by(base_yell_id=i),
+    'get_commentset': lambda i: db.select(CommentSet).filter_by(
+        original_yell_id=i
+    ),
+    'commentset.comment': lambda i: db.select(Comment).filter_by(
+        comment_set_id=i
+    ),
+    'get_tags': lambda i: db.select(Tag).filter_by(original_yell_id=i),
+    'do_rate': lambda i: db.select(Rating).filter_by(
+        original_yell_id=i, critic_id=i % USERS + 1
+    ),
+    "get_yell('rated')": lambda i: db.select(Yell)
+    .order_by(Yell.yell_rating.desc())
+    .limit(1),
+}
+
+
+def run():
+    ids = [random.randint(1, YELLS) for _ in range(LOOKUPS)]
+    timings = {}
+    for name, lookup in lookups.items():
+        start = perf_counter()
+        for yell_id in ids:
+            db.session.execute(lookup(yell_id)).scalars().all()
+        timings[name] = (perf_counter() - start) / LOOKUPS * 1000
+    return timings
+
+
+with app.app_context():
+    seed()
+    indexes = [
+        index for table in db.metadata.sorted_tables for index in table.indexes
+    ]
+    for index in indexes:
+        index.drop(db.engine)
+    before = run()
+    for index in indexes:
+        index.create(db.engine)
+    after = run()
+
+print(f'{YELLS} yells, ms per lookup averaged over {LOOKUPS} lookups')
+print(f'{"lookup":<22}{"no index":>10}{"indexed":>10}')
+for name in lookups:
+    print(f'{name:<22}{before[name]:>10.3f}{after[name]:>10.3f}')
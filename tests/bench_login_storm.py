@@ -0,0 +1,70 @@
+"""Measures the latency of the feed API on its own and while a storm of
+login threads hits the same process, along with how many of the logins were
+turned away by the password pool.
+
+    python tests/bench_login_storm.py [logins in flight] [feed requests]
+"""
+
+import os
+import sys
+import tempfile
+from threading import Event, Thread
+from time import perf_counter
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+    tempfile.mkdtemp(), 'app.db'
+)
+os.environ.setdefault('SECRET_KEY', 'bench')
+os.environ.setdefault('SECURITY_PASSWORD_SALT', 'bench')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app
+
+STORM = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+REQUESTS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+client = app.test_client()
+client.post(
+    '/register',
+    data=dict(username='bench', password='bench', confirm_password='bench'),
+)
+
+
+def feed_latency():
+    timings = []
+    for _ in range(REQUESTS):
+        start = perf_counter()
+        client.get('/api/cards/post')
+        timings.append((perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.95)]
+
+
+def storm(stop, outcomes):
+    login = app.test_client()
+    while not stop.is_set():
+        response = login.post(
+            '/login', data=dict(username='bench', password='bench')
+        )
+        outcomes.append(response.status_code)
+
+
+quiet = feed_latency()
+stop = Event()
+outcomes = []
+threads = [Thread(target=storm, args=(stop, outcomes)) for _ in range(STORM)]
+for thread in threads:
+    thread.start()
+stormy = feed_latency()
+stop.set()
+for thread in threads:
+    thread.join()
+
+print(f'{REQUESTS} feed requests, {STORM} login threads')
+print(f'{"":<10}{"p50 ms":>10}{"p95 ms":>10}')
+print(f'{"quiet":<10}{quiet[0]:>10.1f}{quiet[1]:>10.1f}')
+print(f'{"storm":<10}{stormy[0]:>10.1f}{stormy[1]:>10.1f}')
+print(
+    f'logins: {outcomes.count(302)} accepted, '
+    f'{outcomes.count(503)} turned away'
+)
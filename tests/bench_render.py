@@ -0,0 +1,69 @@
+"""Renders a feed worth of markdown bodies through a fresh markdown pipeline
+per call, as the routes used to, and through the cached renderer.
+
+    python tests/bench_render.py [bodies] [repeats]
+"""
+
+import os
+import sys
+import random
+import tempfile
+from time import perf_counter
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+    tempfile.mkdtemp(), 'app.db'
+)
+os.environ.setdefault('SECRET_KEY', 'bench')
+os.environ.setdefault('SECURITY_PASSWORD_SALT', 'bench')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from markdown import markdown
+from markdown.extensions.codehilite import CodeHiliteExtension
+from markdown.extensions.fenced_code import FencedCodeExtension
+from app import clean, markdown_cache, render_markdown
+
+BODIES = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+REPEATS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+words = 'snippet loop list dict parse render cache query index yell'.split()
+
+
+def body(i):
+    prose = ' '.join(random.choices(words, k=60))
+    code = '\n'.join(f'    total += item[{j}] * {i}' for j in range(12))
+    return (
+        f'# Snippet {i}\n\n**{prose}**\n\n'
+        f'```python\ndef f(item):\n    total = 0\n{code}\n    return total\n```\n'
+    )
+
+
+def uncached(text):
+    return markdown(
+        clean(text),
+        extensions=[
+            CodeHiliteExtension(
+                css_class='highlight', pygments_style='one-dark'
+            ),
+            FencedCodeExtension(),
+        ],
+    )
+
+
+def run(render, bodies):
+    start = perf_counter()
+    for _ in range(REPEATS):
+        for text in bodies:
+            render(text)
+    return (perf_counter() - start) / (REPEATS * len(bodies)) * 1000
+
+
+bodies = [body(i) for i in range(BODIES)]
+assert all(uncached(text) == render_markdown(text) for text in bodies[:10])
+markdown_cache.entries.clear()
+before = run(uncached, bodies)
+after = run(render_markdown, bodies)
+
+print(f'{BODIES} bodies rendered {REPEATS} times each, ms per render')
+print(f'{"uncached":<10}{before:>10.3f}')
+print(f'{"cached":<10}{after:>10.3f}')
+print(f'cache hits {markdown_cache.hits}, misses {markdown_cache.misses}')
@@ -0,0 +1,146 @@
+"""Times search_candidates on a seeded trigram index against the query it
+replaced, which read the whole posting list of every query trigram, and
+reports how many of the yells holding every trigram of the query the new
+query still finds.
+
+    python tests/bench_search.py [yells] [queries]
+"""
+
+import os
+import re
+import sys
+import glob
+import random
+import sysconfig
+import tempfile
+from collections import Counter
+from math import ceil
+from time import perf_counter
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+    tempfile.mkdtemp(), 'app.db'
+)
+os.environ.setdefault('SECRET_KEY', 'bench')
+os.environ.setdefault('SECURITY_PASSWORD_SALT', 'bench')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import (
+    app,
+    db,
+    User,
+    Yell,
+    Request,
+    SearchToken,
+    search_candidates,
+    search_trigrams,
+)
+
+YELLS = int(sys.argv[1]) if len(sys.argv) > 1 else 40000
+QUERIES = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+USERS = 1000
+random.seed(0)
+
+# Words of the standard library's source, in their own proportions, read
+# like the English and identifiers of real posts
+words = Counter()
+stdlib = sysconfig.get_path('stdlib')
+for path in sorted(glob.glob(os.path.join(stdlib, '*.py')))[:60]:
+    with open(path, errors='ignore') as file:
+        words.update(re.findall(r'[a-z]{3,12}', file.read().lower()))
+vocabulary, weights = zip(*words.most_common(20000))
+
+
+def sentence(length):
+    return ' '.join(random.choices(vocabulary, weights, k=length))
+
+
+def seed():  # {{{
+    insert = lambda model, rows: db.session.execute(db.insert(model), rows)
+    insert(
+        User,
+        [
+            {'id': i, 'username': f'user{i}', 'hash': '-'}
+            for i in range(1, USERS + 1)
+        ],
+    )
+    for start in range(1, YELLS + 1, 5000):
+        yells, requests, tokens = [], [], []
+        for yell_id in range(start, min(start + 5000, YELLS + 1)):
+            author_id = random.randint(1, USERS)
+            title, body = sentence(5), sentence(15)
+            yells.append(
+                {
+                    'yell_id': yell_id,
+                    'author_id': author_id,
+                    'yell_title': title,
+                    'yell_type': 'req',
+                }
+            )
+            requests.append(
+                {'base_yell_id': yell_id, 'request_content': body}
+            )
+            trigrams = set()
+            for field in (title, body, f'user{author_id}'):
+                trigrams |= search_trigrams(field)
+            tokens += [
+                {'search_token': trigram, 'yell_id': yell_id}
+                for trigram in trigrams
+            ]
+        insert(Yell, yells)
+        insert(Request, requests)
+        insert(SearchToken, tokens)
+    db.session.commit()
+
+
+# }}}
+def full_postings(searched):
+    trigrams = search_trigrams(searched)
+    min_hits = ceil(len(trigrams) * app.config['SEARCH_MIN_OVERLAP'])
+    hits = db.func.count(SearchToken.search_token)
+    return db.session.execute(
+        db.select(SearchToken.yell_id, hits)
+        .where(SearchToken.search_token.in_(trigrams))
+        .group_by(SearchToken.yell_id)
+        .having(hits >= min_hits)
+        .order_by(hits.desc())
+        .limit(app.config['SEARCH_MAX_CANDIDATES'])
+    ).all()
+
+
+def run(search, queries):
+    timings, results = [], []
+    for query in queries:
+        start = perf_counter()
+        results.append(search(query))
+        timings.append((perf_counter() - start) * 1000)
+    timings.sort()
+    p50, p95 = timings[len(timings) // 2], timings[int(len(timings) * 0.95)]
+    return p50, p95, results
+
+
+with app.app_context():
+    seed()
+    postings = db.session.execute(
+        db.select(db.func.count()).select_from(SearchToken)
+    ).scalar()
+    queries = [sentence(random.randint(1, 4)) for _ in range(QUERIES)]
+    before = run(full_postings, queries)
+    after = run(search_candidates, queries)
+
+# Of the yells the old query found holding every trigram of the query, the
+# share the new one also finds, for queries whose matches were not cut off
+# at SEARCH_MAX_CANDIDATES by the old query already
+kept = []
+for query, old, new in zip(queries, before[2], after[2]):
+    matches = {
+        yell_id
+        for yell_id, hits in old
+        if hits == len(search_trigrams(query))
+    }
+    if matches and len(matches) < app.config['SEARCH_MAX_CANDIDATES']:
+        kept.append(len(matches & set(new)) / len(matches))
+print(f'{YELLS} yells, {postings} postings, {QUERIES} queries of 1-4 words')
+print(f'{"":<16}{"p50 ms":>10}{"p95 ms":>10}')
+print(f'{"full postings":<16}{before[0]:>10.1f}{before[1]:>10.1f}')
+print(f'{"candidates":<16}{after[0]:>10.1f}{after[1]:>10.1f}')
+print(f'full matches kept {sum(kept) / len(kept):.0%}')
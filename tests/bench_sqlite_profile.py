@@ -0,0 +1,106 @@
+"""Runs concurrent reader and writer processes against a fresh database for
+every SQLite profile and reports their throughput and lock errors.
+
+    python tests/bench_sqlite_profile.py [seconds] [readers] [writers]
+"""
+
+import os
+import sys
+import tempfile
+import multiprocessing
+from time import perf_counter
+
+os.environ.setdefault('SECRET_KEY', 'bench')
+os.environ.setdefault('SECURITY_PASSWORD_SALT', 'bench')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+    tempfile.mkdtemp(), 'app.db'
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+from app import sqlite_profiles, sqlite_pragmas
+
+SECONDS = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+READERS = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+WRITERS = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+
+def engine_for(path, profile):
+    engine = create_engine(f'sqlite:///{path}')
+    event.listen(engine, 'connect', sqlite_pragmas(profile))
+    return engine
+
+
+def worker(path, profile, role, results):  # {{{
+    engine = engine_for(path, profile)
+    operations = errors = 0
+    end = perf_counter() + SECONDS
+    while perf_counter() < end:
+        try:
+            with engine.begin() as connection:
+                if role == 'write':
+                    # A like: the hot counter row plus an appended rating
+                    connection.execute(
+                        text('UPDATE counter SET total = total + 1')
+                    )
+                    connection.execute(
+                        text('INSERT INTO rating (value) VALUES (1)')
+                    )
+                else:
+                    # A feed page
+                    connection.execute(text('SELECT total FROM counter'))
+                    connection.execute(
+                        text(
+                            'SELECT * FROM rating ORDER BY rating_id DESC '
+                            'LIMIT 15'
+                        )
+                    ).all()
+            operations += 1
+        except OperationalError:
+            errors += 1
+    results.put((role, operations, errors))
+
+
+# }}}
+def run(profile):
+    path = os.path.join(tempfile.mkdtemp(), f'{profile}.db')
+    with engine_for(path, profile).begin() as connection:
+        connection.execute(text('CREATE TABLE counter (total INTEGER)'))
+        connection.execute(text('INSERT INTO counter VALUES (0)'))
+        connection.execute(
+            text(
+                'CREATE TABLE rating (rating_id INTEGER PRIMARY KEY, '
+                'value INTEGER)'
+            )
+        )
+    results = multiprocessing.Queue()
+    roles = ['read'] * READERS + ['write'] * WRITERS
+    processes = [
+        multiprocessing.Process(
+            target=worker, args=(path, profile, role, results)
+        )
+        for role in roles
+    ]
+    for process in processes:
+        process.start()
+    totals = {'read': [0, 0], 'write': [0, 0]}
+    for _ in processes:
+        role, operations, errors = results.get()
+        totals[role][0] += operations
+        totals[role][1] += errors
+    for process in processes:
+        process.join()
+    return totals
+
+
+print(f'{READERS} readers and {WRITERS} writers for {SECONDS}s per profile')
+print(f'{"profile":<10}{"reads/s":>10}{"writes/s":>10}{"lock errors":>13}')
+for profile in sqlite_profiles:
+    totals = run(profile)
+    print(
+        f'{profile:<10}'
+        f'{totals["read"][0] / SECONDS:>10.0f}'
+        f'{totals["write"][0] / SECONDS:>10.0f}'
+        f'{totals["read"][1] + totals["write"][1]:>13}'
+    )